@@ -0,0 +1,106 @@
+"""
+Asyncio support for leak hunts.
+
+Async tests (e.g. with pytest-asyncio) create a new event loop on every
+run and close it afterwards.  Under ``-R`` that is repeated for every
+repetition, and the loop creation dominates both the run time and the
+memory block deltas.  A `SharedEventLoop` makes the event loop policy
+hand out the same loop for all the repetitions of a test, and only
+really closes it at the end of the hunt.
+"""
+import heapq
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None  # Python 2
+
+from . import counters
+
+
+# What asyncio.run() does to a loop when it is done with it, only done
+# by uninstall() to the shared loop
+_FINALIZERS = ('shutdown_asyncgens', 'shutdown_default_executor', 'close')
+
+
+def _noop_coroutine(*args, **kwargs):
+    return asyncio.sleep(0)
+
+
+class SharedEventLoop(object):
+    """One event loop reused across the repetitions of a leak hunt."""
+
+    def __init__(self):
+        self.loop = None
+        self._policy = None
+
+    def install(self):
+        """Make the event loop policy return the shared loop."""
+        policy = asyncio.get_event_loop_policy()
+        new_event_loop = policy.new_event_loop
+
+        def shared_new_event_loop():
+            if self.loop is None or self.loop.is_closed():
+                self.loop = new_event_loop()
+                # Shut down and closed for real by uninstall()
+                self.loop.shutdown_asyncgens = _noop_coroutine
+                self.loop.shutdown_default_executor = _noop_coroutine
+                self.loop.close = lambda: None
+            return self.loop
+
+        policy.new_event_loop = shared_new_event_loop
+        self._policy = policy
+
+    def uninstall(self):
+        """Restore the policy and close the shared loop."""
+        if self._policy is not None:
+            del self._policy.new_event_loop
+            self._policy = None
+        loop, self.loop = self.loop, None
+        if loop is not None:
+            for name in _FINALIZERS:
+                delattr(loop, name)
+            if not loop.is_running() and not loop.is_closed():
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                if hasattr(loop, 'shutdown_default_executor'):
+                    # Python >= 3.9
+                    loop.run_until_complete(
+                        loop.shutdown_default_executor())
+                loop.close()
+
+    def cleanup(self):
+        """Let the shared loop process what the test left behind.
+
+        Runs one iteration of the loop, so that callbacks scheduled by
+        the test (e.g. transports calling ``connection_lost()``) run,
+        and drops cancelled timers, which would otherwise only be purged
+        once they are a large fraction of all timers.
+        """
+        loop = self.loop
+        if loop is None or loop.is_closed() or loop.is_running():
+            return
+        loop.call_soon(loop.stop)
+        loop.run_forever()
+
+        scheduled = getattr(loop, '_scheduled', None)
+        if scheduled:
+            scheduled[:] = [handle for handle in scheduled
+                            if not handle._cancelled]
+            heapq.heapify(scheduled)
+            loop._timer_cancelled_count = 0
+
+    def transport_count(self):
+        """Return the number of open transports of the shared loop."""
+        transports = getattr(self.loop, '_transports', None)
+        if not transports:
+            return 0
+        return sum(1 for transport in list(transports.values())
+                   if transport is not None and not transport.is_closing())
+
+    def counters(self):
+        return [
+            counters.Counter('asyncio tasks', counters.asyncio_task_count,
+                             counters.check_fd_deltas),
+            counters.Counter('asyncio transports', self.transport_count,
+                             counters.check_fd_deltas),
+        ]
@@ -0,0 +1,133 @@
+"""
+Discovery and clearing of ``functools.lru_cache`` and similar caches.
+
+A cache filled by a test grows on every repetition until it is full,
+which looks just like a leak.  ``clear_caches()`` in the refleak engines
+only knows about the caches of the standard library; a `CacheIndex`
+finds the cache wrappers defined at the top level of any module, or in
+its classes, and clears them between repetitions.
+"""
+import fnmatch
+import sys
+import types
+
+try:
+    from functools import _lru_cache_wrapper
+except ImportError:
+    _lru_cache_wrapper = ()  # Python 2
+
+
+# Caches of the test harness itself, refilled by every test
+DEFAULT_ALLOWLIST = ['_pytest.*', 'pytest.*', 'pluggy.*', 'pytest_leaks.*']
+
+
+def is_cache_wrapper(obj):
+    """Return whether `obj` is an ``lru_cache`` or similar cache wrapper.
+
+    Besides ``functools.lru_cache``, plain functions that carry their own
+    ``cache_clear()`` and ``cache_info()`` (as made by e.g. cachetools)
+    are accepted.  Other objects are not asked for these attributes, as
+    mocks would pretend to have them.
+    """
+    if isinstance(obj, _lru_cache_wrapper):
+        return True
+    if isinstance(obj, types.FunctionType):
+        attrs = obj.__dict__
+        return (callable(attrs.get('cache_clear')) and
+                callable(attrs.get('cache_info')))
+    return False
+
+
+def cache_name(wrapper):
+    return '%s:%s' % (getattr(wrapper, '__module__', '?'),
+                      getattr(wrapper, '__qualname__',
+                              getattr(wrapper, '__name__', '?')))
+
+
+class CacheIndex(object):
+    """The cache wrappers of all imported modules.
+
+    The index is built on first use and extended with the modules
+    imported since, each time it is used.  `allowlist` holds fnmatch
+    patterns of ``module:qualname`` names of caches that are known to
+    fill up legitimately: they are cleared, but never reported.
+    """
+
+    def __init__(self, allowlist=()):
+        self.allowlist = list(allowlist)
+        self.wrappers = []
+        self.names = []
+        self._ids = set()
+        self._modules = set()
+        # Number of cleanups; per cache, the cleanup that indexed it and
+        # the number of cleanups that found it filled
+        self._cleanups = 0
+        self._since = []
+        self._filled = []
+
+    def update(self):
+        """Index the cache wrappers of the modules imported since."""
+        names = set(sys.modules)
+        new = names - self._modules
+        # Removed modules are forgotten, to be indexed again if imported
+        # again
+        self._modules = names
+        if not new:
+            return
+        for name, module in list(sys.modules.items()):
+            if name not in new:
+                continue
+            try:
+                namespace = list(vars(module).values())
+            except TypeError:
+                continue
+            for obj in namespace:
+                self._add(obj)
+                if isinstance(obj, type):
+                    for attr in list(vars(obj).values()):
+                        self._add(getattr(attr, '__func__', attr))
+
+    def _add(self, obj):
+        if id(obj) in self._ids or not is_cache_wrapper(obj):
+            return
+        self._ids.add(id(obj))
+        self.wrappers.append(obj)
+        self.names.append(cache_name(obj))
+        self._since.append(self._cleanups)
+        self._filled.append(0)
+
+    def reset(self):
+        """Start counting refills for a new hunt."""
+        self._cleanups = 0
+        for i in range(len(self._filled)):
+            self._since[i] = 0
+            self._filled[i] = 0
+
+    def cleanup(self):
+        """Clear all the caches, counting those that were filled."""
+        self._cleanups += 1
+        self.update()
+        for i, wrapper in enumerate(self.wrappers):
+            info = wrapper.cache_info()
+            if self._cleanups > 1 and getattr(info, 'currsize', 0):
+                self._filled[i] += 1
+            wrapper.cache_clear()
+
+    def refilled(self):
+        """Return the names of the caches refilled by every repetition.
+
+        The first cleanup happens before the first repetition, so it
+        doesn't count; nor do the cleanups before a cache was indexed.
+        """
+        refilled = []
+        for name, since, filled in zip(self.names, self._since,
+                                       self._filled):
+            repetitions = self._cleanups - max(since, 2) + 1
+            if (repetitions >= 1 and filled >= repetitions and
+                    not self.allowed(name)):
+                refilled.append(name)
+        return refilled
+
+    def allowed(self, name):
+        return any(fnmatch.fnmatchcase(name, pattern)
+                   for pattern in self.allowlist)
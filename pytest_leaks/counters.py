@@ -0,0 +1,265 @@
+"""
+Resource counters sampled by the refleak engines in addition to
+references, memory blocks and file descriptors.
+
+A counter is a ``(name, sample, checker)`` tuple: ``sample()`` returns
+the current value as an int, and ``checker(deltas)`` returns True when
+the tracked deltas indicate a leak.  Sampling happens inside the
+measured loop, so ``sample()`` should be cheap and must not keep
+anything alive.
+"""
+import atexit
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from collections import namedtuple
+
+
+Counter = namedtuple('Counter', ['name', 'sample', 'checker'])
+
+
+# These checkers return False on success, True on failure
+
+def check_rc_deltas(deltas):
+    """Flag growth on every tracked repetition (see bpo-30776)."""
+    return all(delta >= 1 for delta in deltas)
+
+
+def check_fd_deltas(deltas):
+    """Flag any change."""
+    return any(deltas)
+
+
+def check_any_growth(deltas):
+    """Flag growth on any tracked repetition."""
+    return any(delta > 0 for delta in deltas)
+
+
+def check_sum_growth(deltas):
+    """Flag a net growth over the tracked repetitions."""
+    return sum(deltas) > 0
+
+
+# Detection strategies overriding the checkers of all counters
+STRATEGIES = {
+    'default': None,
+    'any': check_any_growth,
+    'sum': check_sum_growth,
+}
+
+
+def rss_bytes():
+    """Return the resident set size of the process, from /proc/self/statm.
+    """
+    with open('/proc/self/statm', 'rb') as f:
+        resident = int(f.read().split()[1])
+    return resident * _PAGESIZE
+
+
+def has_rss():
+    return sys.platform.startswith('linux') and os.path.exists(
+        '/proc/self/statm')
+
+
+_PAGESIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _load_mallinfo():
+    if not sys.platform.startswith('linux'):
+        return None
+    import ctypes
+    import ctypes.util
+
+    class Mallinfo2(ctypes.Structure):
+        _fields_ = [(name, ctypes.c_size_t) for name in (
+            'arena', 'ordblks', 'smblks', 'hblks', 'hblkhd', 'usmblks',
+            'fsmblks', 'uordblks', 'fordblks', 'keepcost')]
+
+    class Mallinfo(ctypes.Structure):
+        _fields_ = [(name, ctypes.c_int) for name, _ in Mallinfo2._fields_]
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    except OSError:
+        return None
+    for name, restype in (('mallinfo2', Mallinfo2),
+                          ('mallinfo', Mallinfo)):
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.argtypes = []
+            func.restype = restype
+            return func
+    return None
+
+
+# Loaded on first use: find_library() runs ldconfig in a subprocess
+_mallinfo = []
+
+
+def _get_mallinfo():
+    if not _mallinfo:
+        _mallinfo.append(_load_mallinfo())
+    return _mallinfo[0]
+
+
+def native_heap_bytes():
+    """Return the bytes in use on the glibc malloc heap, mmapped chunks
+    included.
+
+    The pymalloc arenas are part of it, but so is everything C
+    extensions allocate with malloc() directly.
+    """
+    info = _get_mallinfo()()
+    return info.uordblks + info.hblkhd
+
+
+def has_native_heap():
+    return _get_mallinfo() is not None
+
+
+def growth_checker(min_rate=1):
+    """Return a checker flagging growth on every tracked repetition of
+    at least `min_rate` on average.
+    """
+    def check_growth_deltas(deltas):
+        return (all(delta > 0 for delta in deltas) and
+                sum(deltas) >= min_rate * len(deltas))
+    return check_growth_deltas
+
+
+def memory_counters(min_rate=1):
+    """Return the process memory counters available on this platform.
+    """
+    checker = growth_checker(min_rate)
+    counters = []
+    if has_rss():
+        counters.append(Counter('rss bytes', rss_bytes, checker))
+    if has_native_heap():
+        counters.append(Counter('native heap bytes', native_heap_bytes,
+                                checker))
+    return counters
+
+
+def child_process_count():
+    """Return the number of child processes, zombies included.
+    """
+    try:
+        tids = os.listdir('/proc/self/task')
+    except OSError:
+        tids = None
+    if tids and os.path.exists('/proc/self/task/%s/children' % tids[0]):
+        count = 0
+        for tid in tids:
+            try:
+                with open('/proc/self/task/%s/children' % tid, 'rb') as f:
+                    count += len(f.read().split())
+            except OSError:
+                # the thread exited meanwhile
+                pass
+        return count
+
+    multiprocessing = sys.modules.get('multiprocessing')
+    if multiprocessing is None:
+        return 0
+    return len(multiprocessing.active_children())
+
+
+def asyncio_task_count():
+    """Return the number of pending asyncio tasks, in all event loops.
+    """
+    tasks = sys.modules.get('asyncio.tasks')
+    if tasks is None:
+        return 0
+    count = 0
+    for registry in (getattr(tasks, '_scheduled_tasks', None),
+                     getattr(tasks, '_all_tasks', None)):
+        if registry is not None:
+            for task in list(registry):
+                if not task.done():
+                    count += 1
+            break
+    return count
+
+
+def interned_string_count():
+    return sys.getunicodeinternedsize()
+
+
+# The temporary directory of this process, see private_tempdir()
+_tempdir = []
+
+
+def private_tempdir():
+    """Make `tempfile` use a new directory of its own, and return it.
+
+    The system temporary directory is shared with other processes, such
+    as pytest-xdist workers or parallel jobs, whose files would count as
+    leaks.  The directory is removed when the process exits.
+    """
+    if not _tempdir:
+        path = tempfile.mkdtemp(prefix='pytest-leaks-')
+        atexit.register(shutil.rmtree, path, True)
+        _tempdir.append(path)
+    tempfile.tempdir = _tempdir[0]
+    return _tempdir[0]
+
+
+def temp_file_count():
+    """Return the number of entries in the private temporary directory.
+    """
+    return len(os.listdir(_tempdir[0]))
+
+
+def _temp_file_counter():
+    private_tempdir()
+    return Counter('temporary files', temp_file_count, check_fd_deltas)
+
+
+BUILTIN_COUNTERS = {
+    'threads': lambda: Counter('threads', threading.active_count,
+                               check_fd_deltas),
+    'processes': lambda: Counter('child processes', child_process_count,
+                                 check_fd_deltas),
+    'asyncio': lambda: Counter('asyncio tasks', asyncio_task_count,
+                               check_fd_deltas),
+    'interned': lambda: Counter('interned strings', interned_string_count,
+                                check_rc_deltas),
+    'tempfiles': _temp_file_counter,
+}
+
+
+def resolve_counters(spec):
+    """Return the counters named by `spec`.
+
+    `spec` is either the name of a built-in counter (``threads``,
+    ``processes``, ``asyncio``, ``interned`` or ``tempfiles``) or a
+    ``module:attribute`` reference to a counter, a list of counters,
+    or a callable returning either.
+
+    Raises ValueError if `spec` can't be resolved.
+    """
+    if spec in BUILTIN_COUNTERS:
+        if spec == 'interned' and not hasattr(sys, 'getunicodeinternedsize'):
+            raise ValueError("counting interned strings requires "
+                             "Python >= 3.12")
+        return [BUILTIN_COUNTERS[spec]()]
+
+    modname, sep, attr = spec.partition(':')
+    if not sep or not modname or not attr:
+        raise ValueError("unknown counter %r" % (spec,))
+    try:
+        obj = importlib.import_module(modname)
+        for name in attr.split('.'):
+            obj = getattr(obj, name)
+    except (ImportError, AttributeError) as exc:
+        raise ValueError("can't load counter %r: %s" % (spec, exc))
+
+    if callable(obj) and not isinstance(obj, tuple):
+        obj = obj()
+    if isinstance(obj, tuple):
+        obj = [obj]
+    return [Counter(*counter) for counter in obj]
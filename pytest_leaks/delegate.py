@@ -0,0 +1,193 @@
+"""
+Leak hunts delegated to a debug build of Python.
+
+The test suite runs normally on the interpreter pytest was started with,
+while the node ids of the tests to hunt are sent in batches to a worker
+running on a debug build (``--leaks-python``).  The worker is a single
+process reused across batches: it runs pytest with ``-R`` on each batch
+and streams the reports back as JSON lines, with their ``pytest-leaks``
+sections.
+
+Protocol, one JSON object per line:
+
+- to the worker, on its stdin: ``{"args": [...], "nodeids": [...]}`` for
+  every batch, until EOF;
+- from the worker, on its stdout: ``{"report": {...}}`` for every call
+  report and failed report, then ``{"status": N}`` at the end of a batch.
+"""
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+import threading
+
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
+
+
+def is_debug_build(python):
+    """Return whether `python` runs a debug build of Python."""
+    try:
+        return subprocess.call(
+            [python, '-c',
+             'import sys; sys.exit(not hasattr(sys, "gettotalrefcount"))']
+        ) == 0
+    except OSError:
+        return False
+
+
+def report_to_dict(report):
+    longrepr = report.longrepr
+    if longrepr is not None:
+        longrepr = str(longrepr)
+    return {
+        'nodeid': report.nodeid,
+        'location': list(report.location),
+        'when': report.when,
+        'outcome': report.outcome,
+        'longrepr': longrepr,
+        'sections': [list(section) for section in report.sections],
+        'duration': getattr(report, 'duration', 0),
+    }
+
+
+def report_from_dict(data, report_class):
+    return report_class(
+        data['nodeid'], tuple(data['location']), {}, data['outcome'],
+        data['longrepr'], data['when'],
+        sections=[tuple(section) for section in data['sections']],
+        duration=data['duration'])
+
+
+def read_checkpoint(path):
+    """Return the report dicts of a checkpoint file, by node id.
+
+    A missing file is empty.  A truncated last line, left by a crash
+    while writing it, is ignored; other invalid lines raise ValueError.
+    """
+    reports = OrderedDict()
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return reports
+    for lineno, line in enumerate(lines, 1):
+        try:
+            data = json.loads(line)
+        except ValueError:
+            if lineno == len(lines):
+                break
+            raise ValueError("invalid line %d in checkpoint file %s"
+                             % (lineno, path))
+        reports[data['nodeid']] = data
+    return reports
+
+
+class DelegateProcess(object):
+    """A worker process on a debug build, fed with batches of node ids."""
+
+    def __init__(self, python, args, cwd=None):
+        self.args = list(args)
+        self.reports = []  # report dicts, in arrival order
+        self.statuses = []  # pytest exit status of every batch
+        self.proc = subprocess.Popen(
+            [python, '-m', 'pytest_leaks.delegate'], cwd=cwd,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        # Threads keep both pipes moving while the suite runs
+        self._batches = queue.Queue()
+        self._writer = threading.Thread(target=self._write_batches)
+        self._reader = threading.Thread(target=self._read_results)
+        for thread in (self._writer, self._reader):
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, nodeids):
+        """Queue a batch of node ids to hunt."""
+        if nodeids:
+            self._batches.put(list(nodeids))
+
+    def close(self):
+        """Wait for all batches to finish and return the exit status."""
+        self._batches.put(None)
+        self._writer.join()
+        self._reader.join()
+        return self.proc.wait()
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+    def _write_batches(self):
+        try:
+            while True:
+                nodeids = self._batches.get()
+                if nodeids is None:
+                    break
+                request = {'args': self.args, 'nodeids': nodeids}
+                self.proc.stdin.write(
+                    json.dumps(request).encode('utf-8') + b'\n')
+                self.proc.stdin.flush()
+        except (IOError, OSError):
+            pass  # the worker died: its exit status tells
+        finally:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def _read_results(self):
+        for line in iter(self.proc.stdout.readline, b''):
+            message = json.loads(line.decode('utf-8'))
+            if 'report' in message:
+                self.reports.append(message['report'])
+            elif 'status' in message:
+                self.statuses.append(message['status'])
+
+
+class ReportStreamer(object):
+    """Worker-side plugin writing the reports to the main process."""
+
+    def __init__(self, out):
+        self.out = out
+
+    def send(self, message):
+        self.out.write(json.dumps(message) + '\n')
+        self.out.flush()
+
+    def pytest_runtest_logreport(self, report):
+        if report.when == 'call' or report.failed:
+            self.send({'report': report_to_dict(report)})
+
+
+def main():
+    import pytest
+
+    # Keep the real stdout for the protocol, and send anything else
+    # written to it (terminal output, prints) to /dev/null
+    out = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    streamer = ReportStreamer(out)
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        request = json.loads(line)
+        status = pytest.main(list(request['args']) + request['nodeids'],
+                             plugins=[streamer])
+        streamer.send({'status': int(status)})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
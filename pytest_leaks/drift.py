@@ -0,0 +1,98 @@
+"""
+Session drift: resource counters sampled between tests.
+
+Even a cheap hunt runs every test several times.  A `DriftMonitor` runs
+nothing itself: it cleans up after every test, as the refleak engines
+do between repetitions, and samples the counters.  The growth of the
+whole session is attributed to the tests, and to their modules, where
+it happens, and the tests growing much more than the others are
+flagged as outliers worth hunting.
+"""
+from collections import OrderedDict
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class DriftMonitor(object):
+    """The counter deltas of every test of the session.
+
+    `counters` are ``(name, sample)`` pairs, and `cleanup` is called
+    before every sample.  `minimums` gives, by counter name, the
+    smallest delta that can make an outlier.
+    """
+
+    def __init__(self, counters, cleanup, minimums=None):
+        self.names = [name for name, sample in counters]
+        self.samplers = [sample for name, sample in counters]
+        self.cleanup = cleanup
+        self.minimums = dict(minimums or ())
+        self.deltas = OrderedDict()  # nodeid -> delta per counter
+        self._last = None
+
+    def _sample(self):
+        self.cleanup()
+        return [sample() for sample in self.samplers]
+
+    def start(self):
+        """Take the baseline sample, before the first test."""
+        self._last = self._sample()
+
+    def sample(self, nodeid):
+        """Attribute the deltas since the previous sample to `nodeid`."""
+        values = self._sample()
+        self.deltas[nodeid] = [value - last
+                               for value, last in zip(values, self._last)]
+        self._last = values
+
+    def totals(self, key=None):
+        """Return the summed deltas, grouped by `key(nodeid)` if given."""
+        totals = OrderedDict()
+        for nodeid, deltas in self.deltas.items():
+            group = key(nodeid) if key is not None else None
+            if group not in totals:
+                totals[group] = [0] * len(self.names)
+            totals[group] = [total + delta for total, delta
+                             in zip(totals[group], deltas)]
+        return totals
+
+    def outliers(self, factor=10):
+        """Return the tests with a counter growing much more than usual.
+
+        A test is an outlier for a counter when its delta is positive,
+        at least the counter's minimum, more than twice the median
+        delta, and exceeds the median by more than `factor` times the
+        median absolute deviation.  For counters that usually don't
+        move, such as file descriptors, that is any growth.  Returns the
+        outlying deltas by node id, as ``{name: delta}``.
+        """
+        thresholds = []
+        for i, name in enumerate(self.names):
+            values = [deltas[i] for deltas in self.deltas.values()]
+            if not values:
+                thresholds.append(None)
+                continue
+            center = median(values)
+            spread = median([abs(value - center) for value in values])
+            thresholds.append(max(center + factor * spread, 2 * center,
+                                  self.minimums.get(name, 0) - 1))
+
+        outliers = OrderedDict()
+        for nodeid, deltas in self.deltas.items():
+            outlying = OrderedDict(
+                (name, delta)
+                for name, delta, threshold
+                in zip(self.names, deltas, thresholds)
+                if delta > 0 and delta > threshold)
+            if outlying:
+                outliers[nodeid] = outlying
+        return outliers
+
+    def describe(self, deltas):
+        return ", ".join("%s: %+d" % (name, delta)
+                         for name, delta in zip(self.names, deltas))
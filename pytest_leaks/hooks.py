@@ -0,0 +1,16 @@
+"""
+Hook specifications of pytest-leaks.
+"""
+
+
+def pytest_leaks_counters(config):
+    """Return a list of extra counters to track in every leak hunt.
+
+    Each counter is a ``(name, sample, checker)`` tuple, see
+    ``pytest_leaks.counters.Counter``: ``sample()`` returns the current
+    value as an int and is called after every repetition, once the
+    cleanup is done; ``checker(deltas)`` gets the tracked deltas and
+    returns True if they indicate a leak.
+
+    :param _pytest.config.Config config: pytest config object
+    """
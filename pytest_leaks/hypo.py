@@ -0,0 +1,39 @@
+"""
+Fewer Hypothesis examples during leak repetitions.
+
+A property-based test runs all its examples on every repetition of a
+leak hunt.  `ReducedExamples` swaps the settings of such a test for a
+copy with fewer examples, no example database and derandomized
+generation, so that repetitions are cheap and run the same examples.
+"""
+
+
+def hypothesis_test(item):
+    """Return the Hypothesis test function run by `item`, or None."""
+    func = getattr(item, 'obj', None)
+    func = getattr(func, '__func__', func)
+    if (getattr(func, 'is_hypothesis_test', False) and
+            hasattr(func, '_hypothesis_internal_use_settings')):
+        return func
+    return None
+
+
+class ReducedExamples(object):
+    """Settings of a Hypothesis test with at most `max_examples`."""
+
+    def __init__(self, func, max_examples):
+        from hypothesis import settings
+
+        self.func = func
+        self.original = func._hypothesis_internal_use_settings
+        self.reduced = settings(
+            self.original,
+            max_examples=min(max_examples, self.original.max_examples),
+            database=None,
+            derandomize=True)
+
+    def install(self):
+        self.func._hypothesis_internal_use_settings = self.reduced
+
+    def uninstall(self):
+        self.func._hypothesis_internal_use_settings = self.original
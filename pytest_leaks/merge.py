@@ -0,0 +1,90 @@
+"""
+Merging the leak results of sharded sessions.
+
+Each shard (``--leaks-shard=I/N``) writes its results to a checkpoint
+file (``--leaks-checkpoint``).  This command reads the checkpoint files
+of all the shards and prints one leaks summary; with ``--durations``,
+it also records the hunt durations of the tests, which balance the
+shards of the next run (``--leaks-durations``).
+
+Usage::
+
+    python -m pytest_leaks.merge --durations durations.json \\
+        shard-1.jsonl shard-2.jsonl ...
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+from collections import OrderedDict
+
+from .delegate import read_checkpoint
+from .plugin import Leaks
+
+
+def merge(paths):
+    """Return the report dicts of all the checkpoint files, by node id."""
+    reports = OrderedDict()
+    for path in paths:
+        reports.update(read_checkpoint(path))
+    return reports
+
+
+def section(report, name):
+    """Return the decoded data of a ``pytest-leaks`` section, or None."""
+    for key, data in report['sections']:
+        if key == name:
+            return json.loads(data, object_pairs_hook=OrderedDict)
+    return None
+
+
+def update_durations(path, reports):
+    """Add the hunt durations of `reports` to the durations file."""
+    durations = OrderedDict()
+    if os.path.exists(path):
+        with open(path) as f:
+            durations.update(json.load(f))
+    for nodeid, report in reports.items():
+        duration = section(report, 'pytest-leaks-duration')
+        if duration is not None:
+            durations[nodeid] = duration
+    with open(path, 'w') as f:
+        json.dump(durations, f, indent=1, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pytest_leaks.merge',
+        description='Merge the leak results of sharded sessions.')
+    parser.add_argument('checkpoints', nargs='+', metavar='CHECKPOINT',
+                        help='checkpoint file written by a shard')
+    parser.add_argument('--durations', metavar='PATH',
+                        help='JSON file to record the hunt durations in')
+    options = parser.parse_args(argv)
+
+    try:
+        reports = merge(options.checkpoints)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    leaked = OrderedDict()
+    for nodeid, report in reports.items():
+        leaks = section(report, 'pytest-leaks')
+        if leaks:
+            leaked[nodeid] = Leaks(leaks)
+
+    print("%d tests hunted in %d shards, %d leaked" % (
+        len(reports), len(options.checkpoints), len(leaked)))
+    for nodeid, leaks in leaked.items():
+        print("%s: %s" % (nodeid, leaks))
+
+    if options.durations:
+        update_durations(options.durations, reports)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+Identification of the objects leaked by a test.
+
+Snapshots of the GC-tracked objects are kept as sorted arrays of object
+ids, which take 8 bytes per object instead of the ~100 of a set of
+ints, and are diffed by merging.
+"""
+import gc
+import heapq
+import sys
+import types
+
+from array import array
+from collections import deque
+
+
+TYPECODE = 'Q'
+
+# Number of ids sorted at once when taking a snapshot
+_CHUNK = 1 << 16
+
+
+def snapshot():
+    """Return the ids of all objects tracked by the GC, as a sorted array.
+    """
+    objects = gc.get_objects()
+    chunks = []
+    for start in range(0, len(objects), _CHUNK):
+        chunks.append(array(TYPECODE, sorted(
+            id(obj) for obj in objects[start:start + _CHUNK])))
+    del objects
+    ids = array(TYPECODE)
+    ids.extend(heapq.merge(*chunks))
+    return ids
+
+
+def _merge(ids, other, common):
+    result = array(TYPECODE)
+    i = 0
+    n = len(other)
+    for ident in ids:
+        while i < n and other[i] < ident:
+            i += 1
+        if (i < n and other[i] == ident) == common:
+            result.append(ident)
+    return result
+
+
+def new_ids(before, after):
+    """Return the ids in the sorted array `after` but not in `before`.
+    """
+    return _merge(after, before, False)
+
+
+def common_ids(ids, other):
+    """Return the ids in both sorted arrays.
+    """
+    return _merge(ids, other, True)
+
+
+def find_objects(ids, limit):
+    """Return up to `limit` GC-tracked objects whose id is in `ids`.
+    """
+    wanted = set(ids)
+    return [obj for obj in gc.get_objects() if id(obj) in wanted][:limit]
+
+
+def _edge(container, child):
+    if isinstance(container, dict):
+        for key, value in container.items():
+            if value is child:
+                return "[%r]" % (key,)
+    elif isinstance(container, (list, tuple)):
+        for index, value in enumerate(container):
+            if value is child:
+                return "[%d]" % (index,)
+    elif getattr(container, '__dict__', None) is child:
+        return ".__dict__"
+    return " -> %s" % (type(child).__name__,)
+
+
+def referrer_chain(obj, ignore=(), max_depth=8, max_visited=10000):
+    """Return how `obj` is reachable from a module global or a fixture.
+
+    Referrers are searched breadth first, up to `max_depth` levels and
+    `max_visited` objects, not going through frames or the objects in
+    `ignore`.  Returns a string like ``"test_mod.garbage[3]"``, or None
+    if no root was found.
+    """
+    modules = {}
+    for name, module in list(sys.modules.items()):
+        module_dict = getattr(module, '__dict__', None)
+        if module_dict is not None:
+            modules[id(module_dict)] = name
+
+    objs = {id(obj): obj}
+    ignored = set(id(item) for item in ignore)
+    ignored.update((id(objs), id(ignore), id(modules)))
+    queue = deque([(id(obj), ())])
+    try:
+        while queue:
+            target_id, path = queue.popleft()
+            if len(path) >= max_depth:
+                continue
+            for referrer in gc.get_referrers(objs[target_id]):
+                rid = id(referrer)
+                if (rid in objs or rid in ignored or
+                        isinstance(referrer, types.FrameType)):
+                    continue
+                if len(objs) > max_visited:
+                    return None
+                objs[rid] = referrer
+                chain = (target_id,) + path
+                root = None
+                if rid in modules:
+                    root = modules[rid]
+                    chain = (rid,) + chain
+                elif type(referrer).__name__ == 'FixtureDef':
+                    root = "fixture %r" % (referrer.argname,)
+                    chain = (rid,) + chain
+                if root is not None:
+                    return root + _describe_chain(
+                        [objs[ident] for ident in chain])
+                queue.append((rid, chain))
+    finally:
+        objs.clear()
+    return None
+
+
+def _describe_chain(chain):
+    # chain goes from the root container down to the leaked object
+    parts = []
+    for container, child in zip(chain, chain[1:]):
+        edge = _edge(container, child)
+        if parts == [] and isinstance(container, dict) and \
+                edge.startswith("['"):
+            edge = "." + edge[2:-2]
+        parts.append(edge)
+    return "".join(parts)
+
+
+def describe(obj, max_repr=80):
+    text = repr(obj)
+    if len(text) > max_repr:
+        text = text[:max_repr - 3] + "..."
+    return "%s %s" % (type(obj).__name__, text)
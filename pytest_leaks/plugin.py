@@ -4,14 +4,34 @@ A pytest plugin to trace resource leaks
 """
 from __future__ import print_function
 
+import os
 import sys
 import re
 import json
+import inspect
+import time
+import zlib
 
 from collections import OrderedDict
 
 import pytest
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 2
+
+# The modules of optional features are imported when they are used,
+# so that loading the plugin stays cheap for sessions without -R
+from . import counters
+from . import hypo
+from . import support
+
+
+try:
+    from _pytest.outcomes import OutcomeException
+except ImportError:
+    from _pytest.runner import OutcomeException  # pytest < 3.3
 
 try:
     from _pytest.doctest import DoctestItem
@@ -25,9 +45,12 @@ if sys.version_info < (3,):
 elif sys.version_info < (3, 7):
     from . import refleak_35 as refleak
     refleak_ver = '35'
-else:
+elif sys.version_info < (3, 11):
     from . import refleak_38 as refleak
     refleak_ver = '38'
+else:
+    from . import refleak_311 as refleak
+    refleak_ver = '311'
 
 
 class Leaks(OrderedDict):
@@ -37,6 +60,11 @@ class Leaks(OrderedDict):
         return "leaked {}".format(msg)
 
 
+def pytest_addhooks(pluginmanager):
+    from . import hooks
+    pluginmanager.add_hookspecs(hooks)
+
+
 def pytest_addoption(parser):
     group = parser.getgroup('leaks')
     group.addoption(
@@ -53,29 +81,367 @@ respectively), and the minimal invocation is '-R :'.
 '''
     )
 
+    group.addoption(
+        '--leaks-calibrate',
+        action='store_true',
+        dest='leaks_calibrate',
+        default=False,
+        help='''\
+before the first leak hunt, run a no-op test through the full
+leak-hunting path to measure the background noise of the harness
+(pytest plugins, logging, capture) and discount it from the verdicts.
+'''
+    )
+
+    group.addoption(
+        '--leaks-screen',
+        action='store',
+        dest='leaks_screen',
+        default=None,
+        metavar='STAB:RUN',
+        help='''\
+screen every test with a cheap hunt first (default '1:2') and only
+re-hunt the suspects with the full '-R' repetition counts.
+'''
+    )
+
+    group.addoption(
+        '--leaks-memory',
+        action='store_true',
+        dest='leaks_memory',
+        default=False,
+        help='''\
+also track the process RSS and the native (malloc) heap size, and
+report tests that grow them on every tracked repetition.
+'''
+    )
+    group.addoption(
+        '--leaks-memory-rate',
+        action='store',
+        dest='leaks_memory_rate',
+        default='1',
+        metavar='SIZE',
+        help='''\
+minimal average growth per repetition for --leaks-memory to report a
+leak, e.g. 4K (default: 1 byte).
+'''
+    )
+    group.addoption(
+        '--leaks-memory-limit',
+        action='store',
+        dest='leaks_memory_limit',
+        default=None,
+        metavar='SIZE',
+        help='''\
+abort the leak hunt of a test, failing it, as soon as the process RSS
+exceeds SIZE, e.g. 2G.
+'''
+    )
+
+    group.addoption(
+        '--leaks-phases',
+        action='store_true',
+        dest='leaks_phases',
+        default=False,
+        help='''\
+attribute the leaks of a test to its call or to its fixtures, by
+hunting it again with the call skipped and then hunting each of its
+function-scoped fixtures on its own.
+'''
+    )
+
+    group.addoption(
+        '--leaks-families',
+        action='store',
+        dest='leaks_families',
+        type=int,
+        default=None,
+        metavar='N',
+        help='''\
+of every parametrized test function, hunt only a fixed sample of N
+instances and run the others normally, unless a sampled instance
+leaks: then all instances are hunted.
+'''
+    )
+
+    group.addoption(
+        '--leaks-sample',
+        action='store',
+        dest='leaks_sample',
+        default=None,
+        metavar='K/N',
+        help='''\
+hunt leaks only in K out of N tests, chosen by a stable hash of their
+node ids and a rotation counter kept in the pytest cache, and run the
+others normally.  Over consecutive runs the rotation covers every test.
+'''
+    )
+
+    group.addoption(
+        '--leaks-objects',
+        action='store_true',
+        dest='leaks_objects',
+        default=False,
+        help='''\
+for leaking tests, identify the new objects that survive a repetition
+and show how they are referenced from a module global or a fixture.
+'''
+    )
+
+    group.addoption(
+        '--leaks-asyncio',
+        action='store_true',
+        dest='leaks_asyncio',
+        default=False,
+        help='''\
+reuse one asyncio event loop across the repetitions of a test, let it
+process pending callbacks between repetitions, and track pending tasks
+and open transports.
+'''
+    )
+
+    group.addoption(
+        '--leaks-clear-caches',
+        action='store_true',
+        dest='leaks_clear_caches',
+        default=False,
+        help='''\
+find the functools.lru_cache (and similar) caches of all imported
+modules, clear them between repetitions, and report the caches that
+each test refills on every repetition.
+'''
+    )
+
+    group.addoption(
+        '--leaks-drift',
+        action='store_true',
+        dest='leaks_drift',
+        default=False,
+        help='''\
+don't hunt leaks: run every test once, clean up and sample the counters
+after each test, and report where the session grows, with the outlying
+tests worth hunting.
+'''
+    )
+
+    group.addoption(
+        '--leaks-deferred',
+        action='store_true',
+        dest='leaks_deferred',
+        default=False,
+        help='''\
+run the whole suite normally first, then hunt leaks in the tests that
+passed, so that failures are reported without waiting for the hunts.
+Not available with pytest-xdist or --junitxml.
+'''
+    )
+
+    group.addoption(
+        '--leaks-checkpoint',
+        action='store',
+        dest='leaks_checkpoint',
+        default=None,
+        metavar='PATH',
+        help='''\
+write the results of the tests hunted to PATH, one JSON line per
+test, as soon as each test is done.
+'''
+    )
+
+    group.addoption(
+        '--leaks-resume',
+        action='store_true',
+        dest='leaks_resume',
+        default=False,
+        help='''\
+don't run the tests whose results are already in the --leaks-checkpoint
+file; report the results from the file instead, and add to it.
+'''
+    )
+
+    group.addoption(
+        '--leaks-shard',
+        action='store',
+        dest='leaks_shard',
+        default=None,
+        metavar='I/N',
+        help='''\
+run only the I-th of N shards of the tests, balanced by the hunt
+durations of --leaks-durations if given, or else by a stable hash of
+their node ids.
+'''
+    )
+
+    group.addoption(
+        '--leaks-durations',
+        action='store',
+        dest='leaks_durations',
+        default=None,
+        metavar='PATH',
+        help='''\
+JSON file of the hunt durations of the tests, as written by
+"python -m pytest_leaks.merge --durations", to balance --leaks-shard.
+'''
+    )
+
+    group.addoption(
+        '--leaks-settle',
+        action='store_true',
+        dest='leaks_settle',
+        default=False,
+        help='''\
+stop warming up a test early, as soon as two warm-up repetitions in a
+row left all the counters unchanged (Python >= 3.11).
+'''
+    )
+
+    group.addoption(
+        '--leaks-batch',
+        action='store',
+        dest='leaks_batch',
+        type=int,
+        default=1,
+        metavar='K',
+        help='''\
+run each test K times per measured repetition, and divide the deltas
+by K: the cleanup between repetitions is paid once per K runs, and
+noise smaller than K per repetition drops out.
+'''
+    )
+
+    group.addoption(
+        '--leaks-fixtures',
+        action='store_true',
+        dest='leaks_fixtures',
+        default=False,
+        help='''\
+before running the tests, hunt leaks in the setup and teardown of
+every module, class, package and session-scoped fixture they use, once
+per fixture definition.
+'''
+    )
+
+    group.addoption(
+        '--leaks-hypothesis-examples',
+        action='store',
+        dest='leaks_hypothesis_examples',
+        type=int,
+        default=10,
+        metavar='N',
+        help='''\
+run Hypothesis tests with at most N examples, no example database and
+derandomized generation during leak repetitions (default: 10); the
+test's regular run keeps its settings.  0 keeps the settings for all
+repetitions.
+'''
+    )
+
+    group.addoption(
+        '--leaks-peak-memory',
+        action='store_true',
+        dest='leaks_peak_memory',
+        default=False,
+        help='''\
+record the peak memory traced by tracemalloc during the call of every
+test, and its net allocated memory blocks, and show the tests using
+the most memory.  Works without -R, on any build.
+'''
+    )
+
+    group.addoption(
+        '--leaks-peak-memory-limit',
+        action='store',
+        dest='leaks_peak_memory_limit',
+        default=None,
+        metavar='SIZE',
+        help='''\
+fail the tests whose peak traced memory exceeds SIZE, e.g. 512M
+(implies --leaks-peak-memory).
+'''
+    )
+
+    group.addoption(
+        '--leaks-python',
+        action='store',
+        dest='leaks_python',
+        default=None,
+        metavar='PYTHON',
+        help='''\
+run the suite normally, and send the tests to hunt in batches to a
+worker process on the given debug build of Python, e.g.
+/usr/bin/python3-dbg.
+'''
+    )
+
     parser.addini('leaks_stab',
                   'the number of times the test is run to let '
                   'gettotalrefcount settle down', default=5)
     parser.addini('leaks_run',
                   'the number of times the test is run', default=4)
+    parser.addini('leaks_cache_allowlist',
+                  'caches cleared by --leaks-clear-caches but not reported, '
+                  'as module:qualname patterns',
+                  type='linelist', default=[])
+    parser.addini('leaks_counters',
+                  'extra resource counters to track: threads, processes, '
+                  'asyncio, interned, tempfiles or module:attribute',
+                  type='linelist', default=[])
 
 
 def pytest_configure(config):
     leaks = config.getvalue("leaks")
-    if leaks:
+    python = config.getvalue("leaks_python")
+    if leaks and python:
+        for dest, option in [('leaks_checkpoint', '--leaks-checkpoint'),
+                             ('leaks_drift', '--leaks-drift')]:
+            if config.getvalue(dest):
+                raise pytest.UsageError("pytest-leaks: %s can't be used "
+                                        "with --leaks-python" % (option,))
+        from . import delegate
+        if not delegate.is_debug_build(python):
+            raise pytest.UsageError(
+                "pytest-leaks: --leaks-python must run a debug build "
+                "of Python")
+
+        # Not registered as 'leaks_checker': the tests hunting leaks
+        # themselves run in the worker
+        config.pluginmanager.register(LeakDelegate(config), 'leaks_delegate')
+    elif leaks or config.getvalue("leaks_drift"):
+        # --leaks-drift needs no -R: it samples the counters of the
+        # refleak engine, but repeats nothing
         if not hasattr(sys, 'gettotalrefcount'):
             raise pytest.UsageError(
                 "pytest-leaks: tracking reference leaks requires "
                 "running on a debug build of Python")
+        if config.getvalue("leaks_deferred"):
+            # The verdicts are added to reports already sent to these
+            if _is_distributed(config):
+                raise pytest.UsageError("pytest-leaks: --leaks-deferred "
+                                        "can't be used with pytest-xdist")
+            if config.getvalue("xmlpath"):
+                raise pytest.UsageError("pytest-leaks: --leaks-deferred "
+                                        "can't be used with --junitxml")
 
         checker = LeakChecker(config)
         config.pluginmanager.register(checker, 'leaks_checker')
 
+    if (config.getvalue("leaks_peak_memory") or
+            config.getvalue("leaks_peak_memory_limit")):
+        config.pluginmanager.register(PeakMemory(config),
+                                      'leaks_peak_memory')
+
     config.addinivalue_line(
         "markers",
         "no_leak_check(fail=False, reason=""): don't run pytest-leaks on "
         "this test, optionally failing the leak test without checking with "
         "some reason given.")
+    config.addinivalue_line(
+        "markers",
+        "leaks(stab=None, run=None, strategy='default', thresholds=None, "
+        "hypothesis_examples=None): override the repetition counts of "
+        "pytest-leaks for this test, its detection strategy ('default', "
+        "'any' or 'sum'), the acceptable delta per repetition of each "
+        "counter, and the Hypothesis examples per repetition.")
 
 
 @pytest.fixture
@@ -83,6 +449,21 @@ def leaks_checker(request):
     return request.config.pluginmanager.get_plugin('leaks_checker')
 
 
+@pytest.fixture
+def leaks_measure(request):
+    """Return a function measuring the leaks of a callable, see `measure`.
+
+    Works without ``-R``, and skips the test when not running on a debug
+    build of Python.
+    """
+    if not hasattr(sys, 'gettotalrefcount'):
+        pytest.skip("leaks_measure requires a debug build of Python")
+    checker = request.config.pluginmanager.get_plugin('leaks_checker')
+    if checker is not None:
+        return checker.measure
+    return measure
+
+
 class LeakChecker(object):
     def __init__(self, config):
         try:
@@ -97,36 +478,783 @@ class LeakChecker(object):
             raise pytest.UsageError("pytest-leaks: invalid value for "
                                     "'leaks_run' in ini file")
 
-        m = re.match(r'^(\d*):(\d*)$', str(config.getvalue("leaks")))
-        if m:
-            if m.group(1):
-                self.stab = int(m.group(1))
-            if m.group(2):
-                self.run = int(m.group(2))
+        leaks = config.getvalue("leaks")
+        if leaks:
+            self.stab, self.run = _parse_stab_run(
+                leaks, self.stab, self.run, "-R")
+
+        screen = config.getvalue("leaks_screen")
+        if screen:
+            self.screen = _parse_stab_run(screen, 1, 2, "--leaks-screen")
+        else:
+            self.screen = None
+
+        self.calibrate = config.getvalue("leaks_calibrate")
+        if self.calibrate and refleak_ver in ('27', '35'):
+            raise pytest.UsageError("pytest-leaks: --leaks-calibrate "
+                                    "requires Python >= 3.7")
+
+        self.counters = []
+        for spec in config.getini('leaks_counters'):
+            try:
+                self.counters.extend(counters.resolve_counters(spec))
+            except ValueError as exc:
+                raise pytest.UsageError("pytest-leaks: invalid value for "
+                                        "'leaks_counters' in ini file: %s"
+                                        % (exc,))
+        for result in config.hook.pytest_leaks_counters(config=config):
+            self.counters.extend(counters.Counter(*counter)
+                                 for counter in result)
+        if config.getvalue("leaks_memory"):
+            rate = _parse_size(config.getvalue("leaks_memory_rate"),
+                               "--leaks-memory-rate")
+            self.counters.extend(counters.memory_counters(rate))
+
+        limit = config.getvalue("leaks_memory_limit")
+        if limit:
+            if not counters.has_rss():
+                raise pytest.UsageError("pytest-leaks: --leaks-memory-limit "
+                                        "requires /proc/self/statm")
+            self.memory_limit = _parse_size(limit, "--leaks-memory-limit")
+        else:
+            self.memory_limit = None
+
+        if ((self.counters or self.memory_limit) and
+                refleak_ver in ('27', '35')):
+            raise pytest.UsageError("pytest-leaks: extra counters and "
+                                    "memory tracking require Python >= 3.7")
+
+        self.phases = config.getvalue("leaks_phases")
+        if self.phases and refleak_ver in ('27', '35'):
+            raise pytest.UsageError("pytest-leaks: --leaks-phases "
+                                    "requires Python >= 3.7")
+
+        self.family_sample = config.getvalue("leaks_families")
+        if self.family_sample is not None and self.family_sample < 1:
+            raise pytest.UsageError("pytest-leaks: invalid value for "
+                                    "--leaks-families option")
+        # family key -> {'size': ..., 'sampled': set of nodeids,
+        #                'leaked': bool}
+        self._families = OrderedDict()
+
+        sample = config.getvalue("leaks_sample")
+        if sample:
+            m = re.match(r'^(\d+)/(\d+)$', sample)
+            if not m or not 0 < int(m.group(1)) <= int(m.group(2)):
+                raise pytest.UsageError("pytest-leaks: invalid value for "
+                                        "--leaks-sample option")
+            self.sample = (int(m.group(1)), int(m.group(2)))
+            cache = getattr(config, 'cache', None)
+            if cache is not None:
+                self.rotation = cache.get('leaks/rotation', 0)
+            else:
+                self.rotation = 0
+        else:
+            self.sample = None
+        self._sampled = [0, 0]  # hunted, seen
+
+        shard = config.getvalue("leaks_shard")
+        if shard:
+            m = re.match(r'^(\d+)/(\d+)$', shard)
+            if not m or not 0 < int(m.group(1)) <= int(m.group(2)):
+                raise pytest.UsageError("pytest-leaks: invalid value for "
+                                        "--leaks-shard option")
+            self.shard = (int(m.group(1)), int(m.group(2)))
+        else:
+            self.shard = None
+        self.durations = {}
+        durations = config.getvalue("leaks_durations")
+        if durations and os.path.exists(durations):
+            try:
+                with open(durations) as f:
+                    self.durations = dict(json.load(f))
+            except (ValueError, TypeError):
+                raise pytest.UsageError("pytest-leaks: invalid durations "
+                                        "file %s" % (durations,))
+        # tests selected, tests collected, estimated hunt duration
+        self._shard_size = None
+
+        self.identify = config.getvalue("leaks_objects")
+        if self.identify and refleak_ver in ('27', '35'):
+            raise pytest.UsageError("pytest-leaks: --leaks-objects "
+                                    "requires Python >= 3.7")
+
+        self.asyncio = config.getvalue("leaks_asyncio")
+        if self.asyncio and refleak_ver in ('27', '35'):
+            raise pytest.UsageError("pytest-leaks: --leaks-asyncio "
+                                    "requires Python >= 3.7")
+        # The event loop shared by the hunts of the current test
+        self._shared_loop = None
+        # Settings of the `leaks` marker of the current test
+        self._overrides = {}
+
+        if config.getvalue("leaks_clear_caches"):
+            if refleak_ver in ('27', '35'):
+                raise pytest.UsageError("pytest-leaks: --leaks-clear-caches "
+                                        "requires Python >= 3.7")
+            from . import caches
+            self.cache_index = caches.CacheIndex(
+                caches.DEFAULT_ALLOWLIST +
+                config.getini('leaks_cache_allowlist'))
         else:
+            self.cache_index = None
+
+        self.batch = config.getvalue("leaks_batch")
+        if self.batch < 1:
+            raise pytest.UsageError("pytest-leaks: invalid value for "
+                                    "--leaks-batch option")
+        if self.batch > 1 and refleak_ver in ('27', '35'):
+            raise pytest.UsageError("pytest-leaks: --leaks-batch "
+                                    "requires Python >= 3.7")
+
+        self.settle = config.getvalue("leaks_settle")
+        if self.settle and refleak_ver != '311':
+            raise pytest.UsageError("pytest-leaks: --leaks-settle "
+                                    "requires Python >= 3.11")
+
+        self.hunt_fixtures = config.getvalue("leaks_fixtures")
+        if self.hunt_fixtures and refleak_ver in ('27', '35'):
+            raise pytest.UsageError("pytest-leaks: --leaks-fixtures "
+                                    "requires Python >= 3.7")
+        # fixture description -> leaks, or error message
+        self._fixture_leaks = OrderedDict()
+        self._fixtures_hunted = 0
+
+        self.hypothesis_examples = config.getvalue(
+            "leaks_hypothesis_examples")
+        if self.hypothesis_examples < 0:
             raise pytest.UsageError("pytest-leaks: invalid value for "
-                                    "-R option")
+                                    "--leaks-hypothesis-examples option")
+
+        self.drift = config.getvalue("leaks_drift")
+        if self.drift and refleak_ver in ('27', '35'):
+            raise pytest.UsageError("pytest-leaks: --leaks-drift "
+                                    "requires Python >= 3.7")
+        self._drift_monitor = None
+
+        self.deferred = config.getvalue("leaks_deferred")
+        # Tests to hunt after the run, and the call reports of the tests
+        # that passed, by node id
+        self._deferred = []
+        self._passed = {}
+        self._failed = set()  # node ids that didn't pass
+
+        self.checkpoint = config.getvalue("leaks_checkpoint")
+        resume = config.getvalue("leaks_resume")
+        if resume and not self.checkpoint:
+            raise pytest.UsageError("pytest-leaks: --leaks-resume requires "
+                                    "--leaks-checkpoint")
+        # Checkpointed report dicts by node id, and the call reports of
+        # the hunted tests waiting for their teardown
+        self._resumed = OrderedDict()
+        self._pending = {}
+        self._restored = 0
+        self._checkpointed = 0
+        self._checkpoint_file = None
+        if resume:
+            from . import delegate
+            try:
+                self._resumed.update(
+                    delegate.read_checkpoint(self.checkpoint))
+            except ValueError as exc:
+                raise pytest.UsageError("pytest-leaks: %s" % (exc,))
+        is_worker = (hasattr(config, 'workerinput') or
+                     hasattr(config, 'slaveinput'))
+        if self.checkpoint and not resume and not is_worker:
+            open(self.checkpoint, 'w').close()
 
         # Get access to the builtin "runner" plugin.
         self.runner = config.pluginmanager.get_plugin('runner')
 
         # Temporary storage for leak data
         self._leaks = {}  # item.nodeid -> result
+        self._sections = {}  # item.nodeid -> {section name: data}
 
-    def hunt_leaks(self, func):
-        return hunt_leaks(func, self.stab, self.run)
+        # Background deltas of the harness itself, per counter
+        self.noise = None
 
-    @pytest.hookimpl(tryfirst=True)
-    def pytest_runtest_protocol(self, item, nextitem):
-        marker = item.get_closest_marker('no_leak_check')
-        if marker:
-            # Don't run leak check
-            if marker.kwargs.get('fail'):
-                reason = marker.kwargs.get('reason', "")
-                self._leaks[item.nodeid] = {'(not checked)': reason}
-            return
+    @pytest.hookimpl(trylast=True)
+    def pytest_collection_modifyitems(self, session, config, items):
+        if self.shard is not None:
+            self._select_shard(config, items)
+        if self.family_sample is not None:
+            self._sample_families(items)
 
-        when = ["setup"]
+    def _select_shard(self, config, items):
+        """Deselect the tests of the other shards.
+
+        Parametrized families stay together.  With recorded durations,
+        the families and tests are assigned longest first to the shard
+        with the least work so far, a test without a duration counting
+        for the average; without any, they are assigned by stable hash.
+        """
+        k, n = self.shard
+        units = OrderedDict()
+        for item in items:
+            key = _family_key(item) or item.nodeid
+            units.setdefault(key, []).append(item)
+
+        known = [self.durations[item.nodeid] for item in items
+                 if item.nodeid in self.durations]
+        estimate = None
+        if known:
+            average = float(sum(known)) / len(known)
+            costs = dict((key, sum(self.durations.get(item.nodeid, average)
+                                   for item in unit))
+                         for key, unit in units.items())
+            loads = [0.0] * n
+            shards = {}
+            for key in sorted(units, key=lambda key: (
+                    -costs[key], _stable_hash(units[key][0]))):
+                shard = loads.index(min(loads))
+                shards[key] = shard
+                loads[shard] += costs[key]
+            estimate = loads[k - 1]
+        else:
+            shards = dict((key, _stable_hash(unit[0]) % n)
+                          for key, unit in units.items())
+
+        selected = []
+        deselected = []
+        for key, unit in units.items():
+            if shards[key] == k - 1:
+                selected.extend(unit)
+            else:
+                deselected.extend(unit)
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+        self._shard_size = (len(selected), len(items), estimate)
+        items[:] = selected
+
+    def _sample_families(self, items):
+        """Select the instances of parametrized tests to hunt.
+
+        The sample of each family is chosen by a stable hash of the node
+        ids, and moved to the front of the family, so that its verdict is
+        known before the other instances run.
+        """
+        positions = OrderedDict()
+        for index, item in enumerate(items):
+            key = _family_key(item)
+            if key is not None:
+                positions.setdefault(key, []).append(index)
+
+        for key, indices in positions.items():
+            if len(indices) <= self.family_sample:
+                continue
+            family = [items[index] for index in indices]
+            sampled = sorted(family, key=_stable_hash)[:self.family_sample]
+            sampled_ids = set(item.nodeid for item in sampled)
+            reordered = (
+                [item for item in family if item.nodeid in sampled_ids] +
+                [item for item in family if item.nodeid not in sampled_ids])
+            for index, item in zip(indices, reordered):
+                items[index] = item
+            self._families[key] = {
+                'size': len(family),
+                'sampled': sampled_ids,
+                'leaked': False,
+            }
+
+    def should_hunt(self, item):
+        """Return whether leaks should be hunted in `item` at all."""
+        if self.sample is not None:
+            k, n = self.sample
+            self._sampled[1] += 1
+            if (_stable_hash(item) + self.rotation) % n >= k:
+                return False
+            self._sampled[0] += 1
+
+        family = self._families.get(_family_key(item))
+        if family is not None and not family['leaked']:
+            return item.nodeid in family['sampled']
+        return True
+
+    @pytest.hookimpl
+    def pytest_sessionfinish(self, session):
+        config = session.config
+        is_worker = (hasattr(config, 'workerinput') or
+                     hasattr(config, 'slaveinput'))
+        cache = getattr(config, 'cache', None)
+        if self.sample is not None and cache is not None and not is_worker:
+            cache.set('leaks/rotation', (self.rotation + 1) % self.sample[1])
+        if self._checkpoint_file is not None:
+            self._checkpoint_file.close()
+            self._checkpoint_file = None
+
+    def write_checkpoint(self, report):
+        """Append the final call `report` of a hunted test to the file."""
+        from . import delegate
+        if self._checkpoint_file is None:
+            self._checkpoint_file = open(self.checkpoint, 'a')
+        self._checkpoint_file.write(
+            json.dumps(delegate.report_to_dict(report)) + '\n')
+        # Survive the loss of the machine, not only of the process
+        self._checkpoint_file.flush()
+        os.fsync(self._checkpoint_file.fileno())
+        self._checkpointed += 1
+
+    def _record_verdict(self, item, leaks):
+        self._leaks[item.nodeid] = leaks
+        if self.checkpoint:
+            self._pending[item.nodeid] = None
+        family = self._families.get(_family_key(item))
+        if leaks and family is not None:
+            family['leaked'] = True
+
+    def hunt_leaks(self, func, stab=None, run=None, deltas=None):
+        options = {}
+        if deltas is not None and refleak_ver not in ('27', '35'):
+            options['deltas'] = deltas
+        extra_counters = list(self.counters)
+        if self._shared_loop is not None:
+            names = set(counter.name for counter in extra_counters)
+            extra_counters.extend(counter
+                                  for counter in self._shared_loop.counters()
+                                  if counter.name not in names)
+        if extra_counters:
+            options['counters'] = extra_counters
+        cleanups = []
+        if self._shared_loop is not None:
+            cleanups.append(self._shared_loop.cleanup)
+        if self.cache_index is not None:
+            self.cache_index.reset()
+            cleanups.append(self.cache_index.cleanup)
+        if cleanups:
+            options['cleanups'] = cleanups
+        if self.memory_limit is not None:
+            options['guard'] = self.check_memory_limit
+        allowance = OrderedDict(self.noise or ())
+        for name, threshold in self._overrides.get('thresholds', {}).items():
+            allowance[name] = allowance.get(name, 0) + threshold
+        if self.noise is not None:
+            # Caches were warmed once for the session during calibration
+            options['warm_caches'] = False
+        if allowance:
+            options['allowance'] = allowance
+        if self.batch > 1:
+            options['batch'] = self.batch
+        if self.settle:
+            options['settle'] = True
+        if self._overrides.get('checker') is not None:
+            options['checker'] = self._overrides['checker']
+        if stab is None:
+            stab = self._overrides.get('stab', self.stab)
+        if run is None:
+            run = self._overrides.get('run', self.run)
+        return hunt_leaks(func, stab, run, **options)
+
+    def measure(self, func, repeat=None, warmup=None):
+        """Measure the leaks of `func` with the settings of this session.
+
+        The extra counters and the memory limit apply, but not the
+        calibrated harness noise, which `func` doesn't go through.
+        """
+        if repeat is None:
+            repeat = self.run
+        if warmup is None:
+            warmup = self.stab
+        options = {}
+        if self.counters:
+            options['counters'] = self.counters
+        if self.memory_limit is not None:
+            options['guard'] = self.check_memory_limit
+        return measure(func, repeat, warmup, **options)
+
+    def hunt_item_leaks(self, item, nextitem, func):
+        """Hunt leaks in `func`, running `item`, with screening if enabled.
+
+        A test is screened with the cheap repetition counts first; only
+        a suspect is hunted again with the full counts.
+        """
+        # The raw deltas go to the checkpoint file with the report
+        deltas = OrderedDict() if self.checkpoint else None
+        if self.screen is None:
+            leaks = self.hunt_leaks(func, deltas=deltas)
+        else:
+            suspect = self.hunt_leaks(func, *self.screen, deltas=deltas)
+            if not suspect:
+                self._record_caches(item)
+                if deltas:
+                    self._add_section(item, 'deltas', deltas)
+                return suspect
+
+            leaks = self.hunt_leaks(func, deltas=deltas)
+            self._add_section(item, 'screen', OrderedDict([
+                ('suspect', suspect),
+                ('confirmed', bool(leaks)),
+            ]))
+        self._record_caches(item)
+        if deltas:
+            self._add_section(item, 'deltas', deltas)
+
+        if leaks and self.phases:
+            self._add_section(item, 'phases',
+                              self.attribute_leaks(item, nextitem, leaks))
+        if leaks and self.identify:
+            self._add_section(item, 'objects', self.identify_objects(func))
+        return leaks
+
+    def _record_caches(self, item):
+        """Report the caches refilled by every repetition of the last hunt.
+        """
+        if self.cache_index is not None:
+            refilled = self.cache_index.refilled()
+            if refilled:
+                self._add_section(item, 'caches', refilled)
+
+    def identify_objects(self, func, limit=10):
+        """Return the GC-tracked objects that survive a run of `func`.
+
+        The ids of all GC-tracked objects are snapshot after a warm-up
+        and two tracked repetitions.  Objects new after the first tracked
+        repetition and still alive after the second one are reported,
+        which leaves out the caches rebuilt by every cleanup.  Each
+        object comes with its referrer chain, if it could be found.
+        """
+        from . import objects
+        snapshots = []
+
+        def take_snapshot():
+            snapshots.append(objects.snapshot())
+
+        hunt_leaks(func, 1, 2, guard=take_snapshot)
+        ids = objects.common_ids(objects.new_ids(snapshots[0], snapshots[1]),
+                                 snapshots[2])
+        del snapshots[:]
+
+        found = objects.find_objects(ids, limit)
+        result = []
+        for obj in found:
+            result.append(OrderedDict([
+                ('object', objects.describe(obj)),
+                ('referrers', objects.referrer_chain(obj, ignore=[found])),
+            ]))
+        del found[:]
+        return result
+
+    def attribute_leaks(self, item, nextitem, leaks):
+        """Find out whether the `leaks` of `item` come from its call or
+        from its fixtures.
+
+        Sampling the counters between phases can't tell: fixture values
+        are alive from setup until teardown.  Instead, the test is hunted
+        again with its call skipped, and if the leaks remain, no-op
+        tests requesting its function-scoped fixtures one at a time are
+        hunted as well.  Returns a mapping from each leaking counter to
+        its source, ``call`` or ``fixtures``, and the leaking fixtures.
+        """
+        sources = OrderedDict(
+            (name, OrderedDict([('source', 'call'), ('fixtures', [])]))
+            for name in leaks)
+
+        setup_leaks = self.hunt_leaks(
+            self._make_run_test(item, nextitem, ["setup"], call=False))
+        suspects = [name for name in sources if name in setup_leaks]
+        for name in suspects:
+            sources[name]['source'] = 'fixtures'
+        if not suspects:
+            return sources
+
+        unattributed = []
+
+        def hunt_probe(argnames):
+            # Methods see the fixtures of their class
+            probe = self._make_probe(
+                item, 'pytest_leaks_probe', argnames,
+                parent=item.getparent(pytest.Class) or item.parent)
+            if _has_params(probe):
+                # The probe has no parameters to give them
+                unattributed.extend(argnames or ['(autouse)'])
+                return probe, None
+            try:
+                return probe, self._hunt_probe(probe, nextitem)
+            except (Exception, OutcomeException):
+                unattributed.extend(argnames or ['(autouse)'])
+                return probe, None
+
+        # Autouse fixtures are part of every probe
+        probe, autouse_leaks = hunt_probe(())
+        autouse = set(probe.fixturenames)
+        autouse_leaks = autouse_leaks or {}
+        for name in suspects:
+            if name in autouse_leaks:
+                sources[name]['fixtures'].append('(autouse)')
+
+        closures = OrderedDict()
+        name2fixturedefs = getattr(getattr(item, '_fixtureinfo', None),
+                                   'name2fixturedefs', {})
+        for argname in item.fixturenames:
+            fixturedefs = name2fixturedefs.get(argname)
+            if (argname in autouse or not fixturedefs or
+                    fixturedefs[-1].scope != 'function'):
+                continue
+            probe, fixture_leaks = hunt_probe((argname,))
+            if fixture_leaks is None:
+                continue
+            for name in suspects:
+                if name in fixture_leaks and name not in autouse_leaks:
+                    closures.setdefault(name, OrderedDict())[argname] = \
+                        set(probe.fixturenames)
+
+        # Report the innermost leaking fixtures only, not the fixtures
+        # depending on them.
+        for name, leaking in closures.items():
+            for argname, closure in leaking.items():
+                if not any(other != argname and other in closure
+                           for other in leaking):
+                    sources[name]['fixtures'].append(argname)
+        if unattributed:
+            # Fixtures that could not be probed on their own
+            for name in suspects:
+                sources[name]['fixtures'].append('(unattributed)')
+        return sources
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtestloop(self, session):
+        if (self.hunt_fixtures and session.items and
+                not session.testsfailed and
+                not session.config.getvalue("collectonly")):
+            self.hunt_fixture_leaks(session.items)
+        if self.drift and not session.config.getvalue("collectonly"):
+            self._drift_monitor = self.make_drift_monitor()
+            self._drift_monitor.start()
+        outcome = yield
+        if (self._deferred and outcome.excinfo is None and
+                not session.shouldfail and not session.shouldstop):
+            self.hunt_deferred_leaks(session)
+
+    def make_drift_monitor(self):
+        """Return a `DriftMonitor` for the counters of the refleak engine.
+
+        Between tests, the engine's cleanup runs with the state saved
+        now, as it does between repetitions.
+        """
+        from . import drift
+        drift_counters = [
+            ('references', refleak.references),
+            ('memory blocks', refleak.memory_blocks),
+            ('file descriptors', support.fd_count),
+        ]
+        if counters.has_rss():
+            drift_counters.append(('rss bytes', counters.rss_bytes))
+        names = set(name for name, sample in drift_counters)
+        drift_counters.extend((counter.name, counter.sample)
+                              for counter in self.counters
+                              if counter.name not in names)
+
+        cleanups = []
+        if self.cache_index is not None:
+            cleanups.append(self.cache_index.cleanup)
+        state = refleak.save_state()
+
+        def cleanup():
+            refleak.dash_R_cleanup(*state, cleanups=cleanups)
+
+        refleak.warm_caches()
+        # The RSS grows by pages, or by whole chunks of the heap, even
+        # for tests that don't leak anything
+        return drift.DriftMonitor(drift_counters, cleanup,
+                                  minimums={'rss bytes': 64 * 1024})
+
+    @pytest.hookimpl
+    def pytest_runtest_logfinish(self, nodeid, location):
+        if self._drift_monitor is not None:
+            self._drift_monitor.sample(nodeid)
+
+    def hunt_deferred_leaks(self, session):
+        """Hunt leaks in the tests that passed during the run.
+
+        The tests were run and reported normally; the verdicts are added
+        to their call reports, which the terminal reporter already holds.
+        Errors during the hunts are reported as new errors.
+        """
+        candidates = [item for item in self._deferred
+                      if item.nodeid in self._passed and
+                      item.nodeid not in self._failed]
+        items = [item for item in candidates if self.should_hunt(item)]
+        self._deferred = []
+
+        tr = session.config.pluginmanager.get_plugin('terminalreporter')
+        if tr is not None and items:
+            tr.ensure_newline()
+            tr.write_sep("-", "hunting leaks in %d tests" % (len(items),))
+        for i, item in enumerate(items):
+            nextitem = items[i + 1] if i + 1 < len(items) else None
+            report = self._passed.pop(item.nodeid)
+            call, when = self._hunt(item, nextitem)
+            if call.excinfo is not None:
+                self._log_hunt_error(item, call, when)
+                letter = 'E'
+            else:
+                self._record_verdict(item, call.result)
+                self._attach_sections(item, report)
+                if self._pending.pop(item.nodeid, False) is None:
+                    # The test's own teardown already passed
+                    self.write_checkpoint(report)
+                letter = '.'
+                if self._leaks_from_report(report) and tr is not None:
+                    # Move the report to the category of leaking tests
+                    tr.stats['passed'].remove(report)
+                    tr.stats.setdefault('leaked', []).append(report)
+                    letter = 'L'
+            if tr is not None:
+                tr.write(letter)
+            if session.shouldfail or session.shouldstop:
+                break
+        if tr is not None and items:
+            tr.ensure_newline()
+        self._passed.clear()
+
+    def hunt_fixture_leaks(self, items):
+        """Hunt leaks in the higher-scoped fixtures used by `items`.
+
+        Every module, class, package or session-scoped fixture is hunted
+        once per definition, with a no-op test requesting it next to the
+        first item using it.  Each repetition sets the fixture up and
+        tears all fixtures down again.  Parametrized fixtures, those
+        depending on them, and those of pytest itself are skipped.  A
+        leaking fixture is not reported when it depends on another
+        leaking fixture.
+        """
+        found = OrderedDict()  # fixturedef -> (argname, item)
+        for item in items:
+            name2fixturedefs = getattr(getattr(item, '_fixtureinfo', None),
+                                       'name2fixturedefs', {})
+            for argname in item.fixturenames:
+                fixturedefs = name2fixturedefs.get(argname)
+                if not fixturedefs:
+                    continue
+                fixturedef = fixturedefs[-1]
+                if (fixturedef.scope == 'function' or fixturedef.params or
+                        _is_pytest_fixture(fixturedefs) or
+                        fixturedef in found):
+                    continue
+                found[fixturedef] = (argname, item)
+
+        hunted = OrderedDict()  # fixturedef -> (leaks, closure)
+        for fixturedef, (argname, item) in found.items():
+            description = _describe_fixture(argname, fixturedef)
+            probe = self._make_probe(item, 'pytest_leaks_fixture',
+                                     (argname,),
+                                     parent=item.getparent(pytest.Class))
+            name2fixturedefs = probe._fixtureinfo.name2fixturedefs
+            if name2fixturedefs.get(argname, [None])[-1] is not fixturedef:
+                continue  # not visible from the probe
+            if _has_params(probe):
+                continue  # depends on a parametrized fixture
+
+            if self.calibrate and self.noise is None:
+                self.calibrate_noise(item)
+            try:
+                leaks = self._hunt_probe(probe, None)
+            except (Exception, OutcomeException) as exc:
+                self._fixture_leaks[description] = "error: %s: %s" % (
+                    type(exc).__name__, exc)
+                continue
+            closure = set(name2fixturedefs[name][-1]
+                          for name in probe.fixturenames
+                          if name2fixturedefs.get(name))
+            hunted[fixturedef] = (description, leaks, closure)
+
+        for fixturedef, (description, leaks, closure) in hunted.items():
+            innermost = Leaks(
+                (name, deltas) for name, deltas in leaks.items()
+                if not any(other is not fixturedef and other in closure and
+                           name in other_leaks and
+                           fixturedef not in other_closure
+                           for other, (_, other_leaks, other_closure)
+                           in hunted.items()))
+            if innermost:
+                self._fixture_leaks[description] = innermost
+        self._fixtures_hunted = len(hunted)
+
+    def _make_probe(self, item, name, argnames=(), parent=None):
+        """Create a no-op test next to `item`, requesting `argnames`.
+
+        The probe is created in the module of `item`, or in `parent`.
+        """
+        def pytest_leaks_probe(*args, **kwargs):
+            pass
+
+        if parent is None:
+            parent = item.getparent(pytest.Module) or item.parent
+
+        parameters = [
+            inspect.Parameter(argname, inspect.Parameter.KEYWORD_ONLY)
+            for argname in argnames]
+        if isinstance(parent, pytest.Class):
+            # pytest leaves out the first argument of methods
+            parameters.insert(0, inspect.Parameter(
+                'self', inspect.Parameter.POSITIONAL_OR_KEYWORD))
+        pytest_leaks_probe.__signature__ = inspect.Signature(parameters)
+        if hasattr(pytest.Function, 'from_parent'):
+            # pytest >= 5.4
+            return pytest.Function.from_parent(
+                parent, name=name, callobj=pytest_leaks_probe)
+        else:
+            return pytest.Function(name, parent=parent,
+                                   callobj=pytest_leaks_probe)
+
+    def _hunt_probe(self, probe, nextitem):
+        """Hunt leaks in the setup and teardown of `probe`.
+
+        The probe is torn down even when a hunt fails, so that the
+        tests that follow find the fixtures as they expect.
+        """
+        try:
+            return self.hunt_leaks(
+                self._make_run_test(probe, nextitem, ["setup"]))
+        except BaseException:
+            probe.ihook.pytest_runtest_teardown(item=probe,
+                                                nextitem=nextitem)
+            raise
+
+    def _add_section(self, item, name, data):
+        self._sections.setdefault(item.nodeid, OrderedDict())[name] = data
+
+    def check_memory_limit(self):
+        rss = counters.rss_bytes()
+        if rss > self.memory_limit:
+            pytest.fail("pytest-leaks: memory limit of %d bytes exceeded "
+                        "(RSS %d bytes)" % (self.memory_limit, rss),
+                        pytrace=False)
+
+    def calibrate_noise(self, item):
+        """Measure the deltas of a no-op test run through `run_test`.
+
+        The no-op test is created next to `item`, so that it goes
+        through the same setup, capture and teardown machinery, but it
+        only uses the fixtures of pytest itself: autouse fixtures of the
+        project may leak, and are hunted with every test.
+        """
+        refleak.warm_caches()
+
+        probe = self._make_probe(item, 'pytest_leaks_calibration')
+        info = probe._fixtureinfo
+        info.names_closure[:] = [
+            name for name in info.names_closure
+            if _is_pytest_fixture(info.name2fixturedefs.get(name))]
+        probe.fixturenames = info.names_closure
+
+        deltas = OrderedDict()
+        hunt_leaks(self._make_run_test(probe, item, ["setup"]),
+                   max(self.stab, 5), max(self.run, 4),
+                   deltas=deltas, counters=self.counters)
+        self.noise = OrderedDict(
+            (name, max(0, max(values) if values else 0))
+            for name, values in deltas.items())
+
+    def _make_run_test(self, item, nextitem, when, call=True, reports=None,
+                       reduced=None):
+        """Return a function running `item` once, without reporting.
+
+        If `reports` is a list, the first run goes through pytest's own
+        protocol instead, and its reports are kept in `reports` to stand
+        for the test's result.  If that run doesn't pass, `HuntAborted`
+        is raised after it.  The `reduced` Hypothesis settings are used
+        for all the other runs.
+        """
         hook = item.ihook
 
         if isinstance(item, DoctestItem):
@@ -137,16 +1265,31 @@ class LeakChecker(object):
             doctest_original_globs = None
 
         def run_test():
+            # As pytest's runtestprotocol() does for reruns.  Keeping the
+            # request across repetitions would save little: on pytest
+            # >= 8 the fixture closure is computed once at collection,
+            # and the fixture values must be set up again anyway.
             hasrequest = hasattr(item, "_request")
             if hasrequest and not item._request:
                 item._initrequest()
 
-            when[0] = "setup"
-            hook.pytest_runtest_setup(item=item)
-            when[0] = "call"
-            hook.pytest_runtest_call(item=item)
-            when[0] = "teardown"
-            hook.pytest_runtest_teardown(item=item, nextitem=nextitem)
+            folded = reports is not None and not reports
+            if reduced is not None:
+                if folded:
+                    reduced.uninstall()
+                else:
+                    reduced.install()
+            if folded:
+                reports.extend(self.runner.runtestprotocol(
+                    item, log=False, nextitem=nextitem))
+            else:
+                when[0] = "setup"
+                hook.pytest_runtest_setup(item=item)
+                if call:
+                    when[0] = "call"
+                    hook.pytest_runtest_call(item=item)
+                when[0] = "teardown"
+                hook.pytest_runtest_teardown(item=item, nextitem=nextitem)
 
             if hasrequest:
                 # Ensure fixtures etc are reset properly
@@ -160,34 +1303,156 @@ class LeakChecker(object):
             # Clear pytest captured output etc., if any
             item._report_sections = []
 
-        if hasattr(self.runner.CallInfo, 'from_call'):
-            # pytest >= 4
-            from _pytest.outcomes import Exit
-            call = self.runner.CallInfo.from_call(
-                lambda: self.hunt_leaks(run_test), 'leakshunt',
-                reraise=(KeyboardInterrupt, Exit))
+            if folded and not all(report.passed for report in reports):
+                raise HuntAborted()
+
+        return run_test
+
+    def _skip_marked(self, item):
+        """Return whether `item` is marked with `no_leak_check`."""
+        marker = item.get_closest_marker('no_leak_check')
+        if marker:
+            # Don't run leak check
+            if marker.kwargs.get('fail'):
+                reason = marker.kwargs.get('reason', "")
+                self._leaks[item.nodeid] = {'(not checked)': reason}
+            return True
+        return False
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        if self.drift:
+            return  # run once, sampled by pytest_runtest_logfinish
+        if item.nodeid in self._resumed:
+            self._restore(item)
+            return True  # skip pytest implementation
+        if self._skip_marked(item):
+            return
+        if self.deferred:
+            self._deferred.append(item)
+            return  # proceed to pytest implementation, hunt afterwards
+        if not self.should_hunt(item):
+            return
+
+        hook = item.ihook
+
+        # pytest's own run of the test is folded into the first warm-up
+        # repetition, whose deltas don't count: the reports it keeps
+        # alive can't be mistaken for a leak there.
+        if self.screen is not None:
+            first_stab = self.screen[0]
         else:
-            # pytest < 4
-            call = self.runner.CallInfo(
-                lambda: self.hunt_leaks(run_test), 'leakshunt')
-
-        if call.excinfo is not None:
-            # Raise errors immediately: it's possible there's some bad
-            # interaction with the leak checking code, so we should
-            # not hide this failure.
-            hook.pytest_runtest_logstart(nodeid=item.nodeid,
-                                         location=item.location)
-            # doctest requires errors are reported with the correct 'when'
-            call.when = when[0]
-            report = hook.pytest_runtest_makereport(item=item, call=call)
-            hook.pytest_runtest_logreport(report=report)
-            hook.pytest_runtest_logfinish(nodeid=item.nodeid,
-                                          location=item.location)
+            first_stab = _marker_overrides(item).get('stab', self.stab)
+        if first_stab > 0 and not _other_protocols(item, self):
+            reports = []
+        else:
+            # Plugins rerunning tests need pytest's run to go through
+            # their own protocol
+            reports = None
+
+        call, when = self._hunt(item, nextitem, reports)
+
+        if call.excinfo is not None and not (
+                reports and call.excinfo.errisinstance(HuntAborted)):
+            self._log_hunt_error(item, call, when)
             return True  # skip pytest implementation
+        elif call.excinfo is None:
+            self._record_verdict(item, call.result)
+
+        if not reports:
+            return  # proceed to pytest implementation
+
+        # The folded run stands for the test's result.  If it didn't
+        # pass, the hunt was aborted and its reports are logged as is.
+        hook.pytest_runtest_logstart(nodeid=item.nodeid,
+                                     location=item.location)
+        for report in reports:
+            if report.when == 'call':
+                self._attach_sections(item, report)
+            hook.pytest_runtest_logreport(report=report)
+        hook.pytest_runtest_logfinish(nodeid=item.nodeid,
+                                      location=item.location)
+        return True  # skip pytest implementation
+
+    def _restore(self, item):
+        """Log the checkpointed report of `item` instead of running it."""
+        from . import delegate
+        hook = item.ihook
+        report = delegate.report_from_dict(self._resumed.pop(item.nodeid),
+                                           self.runner.TestReport)
+        self._restored += 1
+        hook.pytest_runtest_logstart(nodeid=item.nodeid,
+                                     location=item.location)
+        hook.pytest_runtest_logreport(report=report)
+        hook.pytest_runtest_logfinish(nodeid=item.nodeid,
+                                      location=item.location)
+
+    def _hunt(self, item, nextitem, reports=None):
+        """Hunt leaks in `item` and return the call info and phase.
+
+        `reports` is passed on to `_make_run_test`.
+        """
+        when = ["setup"]
+        start = time.time()
+
+        if self.calibrate and self.noise is None:
+            self.calibrate_noise(item)
+
+        self._overrides = _marker_overrides(item)
+
+        examples = self._overrides.get('hypothesis_examples',
+                                       self.hypothesis_examples)
+        func = hypo.hypothesis_test(item)
+        if examples and func is not None:
+            reduced = hypo.ReducedExamples(func, examples)
         else:
-            self._leaks[item.nodeid] = call.result
+            reduced = None
+        run_test = self._make_run_test(item, nextitem, when,
+                                       reports=reports, reduced=reduced)
 
-        return  # proceed to pytest implementation
+        if self.asyncio:
+            from . import aio
+            self._shared_loop = aio.SharedEventLoop()
+            self._shared_loop.install()
+        try:
+            if hasattr(self.runner.CallInfo, 'from_call'):
+                # pytest >= 4
+                from _pytest.outcomes import Exit
+                call = self.runner.CallInfo.from_call(
+                    lambda: self.hunt_item_leaks(item, nextitem, run_test),
+                    'leakshunt',
+                    reraise=(KeyboardInterrupt, Exit))
+            else:
+                # pytest < 4
+                call = self.runner.CallInfo(
+                    lambda: self.hunt_item_leaks(item, nextitem, run_test),
+                    'leakshunt')
+        finally:
+            self._overrides = {}
+            if reduced is not None:
+                reduced.uninstall()
+            if self._shared_loop is not None:
+                self._shared_loop.uninstall()
+                self._shared_loop = None
+        if self.checkpoint:
+            # Recorded for balancing shards
+            self._add_section(item, 'duration',
+                              round(time.time() - start, 3))
+        return call, when[0]
+
+    def _log_hunt_error(self, item, call, when):
+        # Raise errors immediately: it's possible there's some bad
+        # interaction with the leak checking code, so we should
+        # not hide this failure.
+        hook = item.ihook
+        hook.pytest_runtest_logstart(nodeid=item.nodeid,
+                                     location=item.location)
+        # doctest requires errors are reported with the correct 'when'
+        call.when = when
+        report = hook.pytest_runtest_makereport(item=item, call=call)
+        hook.pytest_runtest_logreport(report=report)
+        hook.pytest_runtest_logfinish(nodeid=item.nodeid,
+                                      location=item.location)
 
     @pytest.hookimpl(hookwrapper=True)
     def pytest_runtest_makereport(self, item, call):
@@ -198,22 +1463,61 @@ class LeakChecker(object):
             return
 
         report = outcome.get_result()
+        self._attach_sections(item, report)
+        outcome.force_result(report)
+
+    @pytest.hookimpl
+    def pytest_runtest_logreport(self, report):
+        if report.failed:
+            self._failed.add(report.nodeid)
+            self._pending.pop(report.nodeid, None)
+        elif self.deferred and report.when == 'call' and report.passed:
+            self._passed[report.nodeid] = report
+
+        if report.nodeid in self._pending:
+            # Checkpointed once the teardown passed too
+            if report.when == 'call':
+                self._pending[report.nodeid] = report
+            elif report.when == 'teardown':
+                call_report = self._pending.pop(report.nodeid)
+                if call_report is not None:
+                    self.write_checkpoint(call_report)
+
+    def _attach_sections(self, item, report):
+        """Move the leak data stored for `item` into its call `report`."""
         leaks = self._leaks.pop(item.nodeid, None)
         if leaks:
             report.sections.append(('pytest-leaks', json.dumps(leaks)))
-            outcome.force_result(report)
+
+        sections = self._sections.pop(item.nodeid, {})
+        for name, data in sections.items():
+            report.sections.append(('pytest-leaks-' + name, json.dumps(data)))
 
     def _leaks_from_report(self, report):
         if report.when != "call":
             return None
 
-        leaks = [data for key, data in report.get_sections('pytest-leaks')
+        # get_sections() matches on prefix only
+        leaks = [data for key, data in report.sections
                  if key == 'pytest-leaks']
         if leaks:
             return Leaks(json.loads(leaks[0]))
 
         return None
 
+    def _section_from_report(self, report, name):
+        key = 'pytest-leaks-' + name
+        data = [data for k, data in report.sections if k == key]
+        if data:
+            return json.loads(data[0], object_pairs_hook=OrderedDict)
+        return None
+
+    def _call_reports(self, tr):
+        for reports in tr.stats.values():
+            for rep in reports:
+                if getattr(rep, 'when', None) == 'call':
+                    yield rep
+
     @pytest.hookimpl(hookwrapper=True, trylast=True)
     def pytest_report_teststatus(self, report):
         outcome = yield
@@ -233,6 +1537,12 @@ class LeakChecker(object):
         else:
             leaked = list(tr.getreports('leaked'))
 
+        if self.noise is not None:
+            tr.write_sep("=", 'leaks calibration', cyan=True)
+            tr.line("harness noise per repetition: %s" % ", ".join(
+                "%s: %r" % (name, value)
+                for name, value in self.noise.items()))
+
         if leaked:
             tr.write_sep("=", 'leaks summary', cyan=True)
             for rep in leaked:
@@ -240,12 +1550,525 @@ class LeakChecker(object):
                 if leaks:
                     tr.line("%s: %s" % (rep.nodeid, leaks))
 
+        if self.screen is not None:
+            screened = [(rep, self._section_from_report(rep, 'screen'))
+                        for rep in self._call_reports(tr)]
+            screened = [(rep, data) for rep, data in screened if data]
+            if screened:
+                tr.write_sep("=", 'leaks screening', cyan=True)
+                confirmed = sum(1 for rep, data in screened
+                                if data['confirmed'])
+                tr.line("%d suspects after screening, %d confirmed" % (
+                    len(screened), confirmed))
+                for rep, data in screened:
+                    tr.line("%s: %s (screen %s)" % (
+                        rep.nodeid,
+                        'confirmed' if data['confirmed'] else 'cleared',
+                        Leaks(data['suspect'])))
+
+        if self.sample is not None:
+            k, n = self.sample
+            tr.write_sep("=", 'leaks sampling', cyan=True)
+            tr.line("sample %d/%d, rotation %d: hunted %d of %d tests" % (
+                k, n, self.rotation, self._sampled[0], self._sampled[1]))
+            tr.line("every test is hunted at least once in any %d "
+                    "consecutive runs" % (n - k + 1,))
+
+        if self.identify:
+            identified = [(rep, self._section_from_report(rep, 'objects'))
+                          for rep in self._call_reports(tr)]
+            identified = [(rep, data) for rep, data in identified
+                          if data is not None]
+            if identified:
+                tr.write_sep("=", 'leaked objects', cyan=True)
+                for rep, data in identified:
+                    tr.line("%s:" % (rep.nodeid,))
+                    if not data:
+                        tr.line("    no new GC-tracked objects")
+                    for entry in data:
+                        if entry['referrers'] is None:
+                            tr.line("    %s (no root found)" % (
+                                entry['object'],))
+                        else:
+                            tr.line("    %s (referenced from %s)" % (
+                                entry['object'], entry['referrers']))
+
+        if self.cache_index is not None:
+            refilled = [(rep, self._section_from_report(rep, 'caches'))
+                        for rep in self._call_reports(tr)]
+            refilled = [(rep, data) for rep, data in refilled if data]
+            if refilled:
+                tr.write_sep("=", 'leaks caches', cyan=True)
+                tr.line("caches refilled on every repetition (cleared "
+                        "between repetitions):")
+                for rep, data in refilled:
+                    tr.line("%s: %s" % (rep.nodeid, ", ".join(data)))
+
+        if self._families:
+            tr.write_sep("=", 'leaks families', cyan=True)
+            for (parent, name), family in self._families.items():
+                if family['leaked']:
+                    status = "leaked, all %d instances hunted" % (
+                        family['size'],)
+                else:
+                    status = "%d of %d instances hunted" % (
+                        len(family['sampled']), family['size'])
+                tr.line("%s::%s: %s" % (parent, name, status))
+
+        monitor = self._drift_monitor
+        if monitor is not None and monitor.deltas:
+            tr.write_sep("=", 'leaks drift', cyan=True)
+            tr.line("session growth over %d tests: %s" % (
+                len(monitor.deltas),
+                monitor.describe(monitor.totals()[None])))
+            by_module = monitor.totals(lambda nodeid: nodeid.split('::')[0])
+            for module, deltas in by_module.items():
+                if any(deltas):
+                    tr.line("%s: %s" % (module, monitor.describe(deltas)))
+            outliers = monitor.outliers()
+            if outliers:
+                tr.line("outliers, worth hunting with -R:")
+                for nodeid, outlying in outliers.items():
+                    tr.line("%s: %s" % (nodeid, ", ".join(
+                        "%s: %+d" % (name, delta)
+                        for name, delta in outlying.items())))
+
+        if self._shard_size is not None:
+            selected, collected, estimate = self._shard_size
+            tr.write_sep("=", 'leaks shard', cyan=True)
+            if estimate is None:
+                balance = "assigned by hash"
+            else:
+                balance = "estimated %.1f s of hunting" % (estimate,)
+            tr.line("shard %d/%d: %d of %d tests, %s" % (
+                self.shard + (selected, collected, balance)))
+
+        if self.checkpoint:
+            tr.write_sep("=", 'leaks checkpoint', cyan=True)
+            tr.line("%d tests restored from %s, %d tests added" % (
+                self._restored, self.checkpoint, self._checkpointed))
+
+        if self.hunt_fixtures:
+            tr.write_sep("=", 'leaks in fixtures', cyan=True)
+            tr.line("%d higher-scoped fixtures hunted" % (
+                self._fixtures_hunted,))
+            for description, leaks in self._fixture_leaks.items():
+                tr.line("%s: %s" % (description, leaks))
+
+        if self.phases:
+            attributed = [(rep, self._section_from_report(rep, 'phases'))
+                          for rep in self._call_reports(tr)]
+            attributed = [(rep, data) for rep, data in attributed if data]
+            if attributed:
+                tr.write_sep("=", 'leaks by phase', cyan=True)
+                for rep, data in attributed:
+                    tr.line("%s: %s" % (rep.nodeid, _describe_sources(data)))
+
+
+class LeakDelegate(LeakChecker):
+    """Run the suite normally and hunt leaks in a debug worker process.
+
+    The node ids of the tests to hunt are sent to the worker one module
+    at a time, as soon as the module has run; the worker hunts them while
+    the suite goes on.  Its reports are added to the terminal reporter
+    at the end of the run, so the usual summary sections show them.
+    """
+
+    # Hunting options passed on to the worker, by dest
+    delegated_options = [
+        ('leaks_calibrate', '--leaks-calibrate'),
+        ('leaks_screen', '--leaks-screen'),
+        ('leaks_memory', '--leaks-memory'),
+        ('leaks_memory_rate', '--leaks-memory-rate'),
+        ('leaks_memory_limit', '--leaks-memory-limit'),
+        ('leaks_phases', '--leaks-phases'),
+        ('leaks_objects', '--leaks-objects'),
+        ('leaks_asyncio', '--leaks-asyncio'),
+        ('leaks_clear_caches', '--leaks-clear-caches'),
+        ('leaks_batch', '--leaks-batch'),
+        ('leaks_settle', '--leaks-settle'),
+        ('leaks_fixtures', '--leaks-fixtures'),
+        ('leaks_hypothesis_examples', '--leaks-hypothesis-examples'),
+    ]
+
+    def __init__(self, config):
+        LeakChecker.__init__(self, config)
+        self.python = config.getvalue("leaks_python")
+        self.worker = None
+        self._batch = []
+        self._batches = 0
+        self._worker_errors = []
+
+    def worker_args(self, config):
+        args = ['-q', '-p', 'no:cacheprovider',
+                '--rootdir', _rootdir(config),
+                '-R', '%d:%d' % (self.stab, self.run)]
+        for dest, option in self.delegated_options:
+            value = config.getvalue(dest)
+            if value is True:
+                args.append(option)
+            elif value not in (None, False):
+                args.extend([option, str(value)])
+        return args
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtestloop(self, session):
+        from . import delegate
+        config = session.config
+        if not config.getvalue("collectonly"):
+            self.worker = delegate.DelegateProcess(
+                self.python, self.worker_args(config), cwd=_rootdir(config))
+
+        outcome = yield
+
+        if self.worker is None:
+            return
+        if outcome.excinfo is not None:
+            self.worker.kill()
+            return
+
+        self._submit_batch()
+        status = self.worker.close()
+        for code in self.worker.statuses:
+            # 0: all passed, 1: some tests failed
+            if code not in (0, 1):
+                self._worker_errors.append(
+                    "a batch exited with status %d" % (code,))
+        if status != 0:
+            self._worker_errors.append(
+                "the worker exited with status %d" % (status,))
+        if self._worker_errors:
+            session.testsfailed += 1
+
+        tr = config.pluginmanager.get_plugin('terminalreporter')
+        replaced = set()
+        for data in self.worker.reports:
+            report = delegate.report_from_dict(data, self.runner.TestReport)
+            if report.failed:
+                if report.nodeid in self._failed:
+                    continue  # already reported by the normal run
+                category = 'failed' if report.when == 'call' else 'error'
+                session.testsfailed += 1
+            elif self._leaks_from_report(report):
+                category = 'leaked'
+            elif any(key.startswith('pytest-leaks')
+                     for key, _ in report.sections):
+                category = ''
+            else:
+                continue
+            if category in ('failed', 'leaked'):
+                replaced.add(report.nodeid)
+            if tr is not None:
+                tr.stats.setdefault(category, []).append(report)
+
+        if tr is not None and replaced:
+            # The verdict of the worker stands for the test's result, as
+            # in hunt_deferred_leaks()
+            tr.stats['passed'] = [report
+                                  for report in tr.stats.get('passed', [])
+                                  if report.nodeid not in replaced]
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        if not self._skip_marked(item) and self.should_hunt(item):
+            self._batch.append(item.nodeid)
+        if nextitem is None or nextitem.location[0] != item.location[0]:
+            self._submit_batch()
+        # proceed to pytest implementation
+
+    def _submit_batch(self):
+        if self._batch and self.worker is not None:
+            self.worker.submit(self._batch)
+            self._batches += 1
+        self._batch = []
+
+    @pytest.hookimpl
+    def pytest_terminal_summary(self, terminalreporter, exitstatus):
+        LeakChecker.pytest_terminal_summary(self, terminalreporter,
+                                            exitstatus)
+        if self.worker is None:
+            return
+        tr = terminalreporter
+        tr.write_sep("=", 'leaks delegate', cyan=True)
+        tr.line("%d batches hunted on %s" % (self._batches, self.python))
+        for error in self._worker_errors:
+            tr.line("error: %s" % (error,), red=True)
+
+
+class Measurement(object):
+    """The result of `measure`.
+
+    `deltas` maps every counter to its tracked deltas (Python >= 3.7
+    only), and `leaks` holds the counters found leaking.  A measurement
+    is true when something leaked.
+    """
+
+    def __init__(self, deltas, leaks):
+        self.deltas = deltas
+        self.leaks = leaks
+
+    def __bool__(self):
+        return bool(self.leaks)
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "<Measurement %s>" % (self.leaks or "no leaks",)
+
+
+class PeakMemory(object):
+    """Record the peak traced memory of the call of every test.
+
+    Independent of leak hunting: the peak is measured with tracemalloc,
+    so it works on any build.  Under -R, every repetition is measured,
+    and the report of the test gets the measures of its regular run.
+    """
+
+    # Number of tests shown in the summary
+    top = 10
+
+    def __init__(self, config):
+        if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+            raise pytest.UsageError("pytest-leaks: --leaks-peak-memory "
+                                    "requires Python >= 3.9")
+        limit = config.getvalue("leaks_peak_memory_limit")
+        if limit:
+            self.limit = _parse_size(limit, "--leaks-peak-memory-limit")
+        else:
+            self.limit = None
+        self._started = False
+        self._measures = {}  # item.nodeid -> measures of the last call
+
+    @pytest.hookimpl
+    def pytest_sessionstart(self, session):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+
+    @pytest.hookimpl
+    def pytest_unconfigure(self, config):
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_call(self, item):
+        blocks = sys.getallocatedblocks()
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        yield
+        peak = tracemalloc.get_traced_memory()[1]
+        self._measures[item.nodeid] = OrderedDict([
+            ('peak bytes', peak - current),
+            ('allocated blocks', sys.getallocatedblocks() - blocks),
+        ])
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        if call.when != 'call':
+            return
+        measures = self._measures.pop(item.nodeid, None)
+        if measures is None:
+            return
+
+        report = outcome.get_result()
+        report.sections.append(('pytest-leaks-peak-memory',
+                                json.dumps(measures)))
+        if (self.limit is not None and report.passed and
+                measures['peak bytes'] > self.limit):
+            report.outcome = 'failed'
+            report.longrepr = (
+                "pytest-leaks: peak traced memory of %d bytes exceeds "
+                "the limit of %d bytes" % (measures['peak bytes'],
+                                           self.limit))
+
+    @pytest.hookimpl
+    def pytest_terminal_summary(self, terminalreporter, exitstatus):
+        tr = terminalreporter
+        measured = []
+        for reports in tr.stats.values():
+            for rep in reports:
+                if getattr(rep, 'when', None) != 'call':
+                    continue
+                for key, data in rep.sections:
+                    if key == 'pytest-leaks-peak-memory':
+                        measured.append((rep, json.loads(data)))
+        if not measured:
+            return
+        measured.sort(key=lambda entry: -entry[1]['peak bytes'])
+        tr.write_sep("=", 'leaks peak memory', cyan=True)
+        tr.line("top %d of %d tests by peak traced memory:" % (
+            min(self.top, len(measured)), len(measured)))
+        for rep, measures in measured[:self.top]:
+            tr.line("%s: %d peak bytes, %+d allocated blocks" % (
+                rep.nodeid, measures['peak bytes'],
+                measures['allocated blocks']))
+
+
+class HuntAborted(Exception):
+    """The folded run of a test didn't pass: its leaks aren't hunted."""
+
 
 class Namespace(object):
     pass
 
 
-def hunt_leaks(func, nwarmup, ntracked):
+def _parse_size(value, option):
+    m = re.match(r'^(\d+)([KMG]?)(?:i?B)?$', str(value), re.IGNORECASE)
+    if not m:
+        raise pytest.UsageError("pytest-leaks: invalid value for "
+                                "%s option" % (option,))
+    scale = 1024 ** ' KMG'.index(m.group(2).upper() or ' ')
+    return int(m.group(1)) * scale
+
+
+def _parse_stab_run(value, stab, run, option):
+    m = re.match(r'^(\d*):(\d*)$', str(value))
+    if m:
+        if m.group(1):
+            stab = int(m.group(1))
+        if m.group(2):
+            run = int(m.group(2))
+    else:
+        raise pytest.UsageError("pytest-leaks: invalid value for "
+                                "%s option" % (option,))
+    return stab, run
+
+
+def _marker_overrides(item):
+    """Return the settings of the `leaks` marker closest to `item`."""
+    marker = item.get_closest_marker('leaks')
+    if marker is None:
+        return {}
+
+    def invalid(what):
+        return pytest.UsageError("pytest-leaks: invalid %s in leaks marker "
+                                 "of %s" % (what, item.nodeid))
+
+    overrides = {}
+    for name in ('stab', 'run'):
+        value = marker.kwargs.get(name)
+        if value is not None:
+            if not isinstance(value, int) or value < 0:
+                raise invalid(name)
+            overrides[name] = value
+
+    examples = marker.kwargs.get('hypothesis_examples')
+    if examples is not None:
+        if not isinstance(examples, int) or examples < 0:
+            raise invalid('hypothesis_examples')
+        overrides['hypothesis_examples'] = examples
+
+    strategy = marker.kwargs.get('strategy', 'default')
+    if strategy not in counters.STRATEGIES:
+        raise invalid('strategy %r' % (strategy,))
+    thresholds = marker.kwargs.get('thresholds') or {}
+    if not all(isinstance(value, int) and value >= 0
+               for value in thresholds.values()):
+        raise invalid('thresholds')
+    if ((strategy != 'default' or thresholds) and
+            refleak_ver in ('27', '35')):
+        raise pytest.UsageError("pytest-leaks: strategy and thresholds "
+                                "in leaks marker require Python >= 3.7")
+    overrides['checker'] = counters.STRATEGIES[strategy]
+    overrides['thresholds'] = thresholds
+    return overrides
+
+
+def _family_key(item):
+    """Return the key of the parametrized function `item` belongs to."""
+    if getattr(item, 'callspec', None) is None:
+        return None
+    name = getattr(item, 'originalname', None) or item.name.split('[')[0]
+    return (item.parent.nodeid, name)
+
+
+def _stable_hash(item):
+    return zlib.crc32(item.nodeid.encode('utf-8')) & 0xffffffff
+
+
+def _describe_fixture(argname, fixturedef):
+    func = fixturedef.func
+    return "%s (%s scope, %s:%s)" % (
+        argname, fixturedef.scope, getattr(func, '__module__', '?'),
+        getattr(func, '__qualname__', getattr(func, '__name__', '?')))
+
+
+def _rootdir(config):
+    # config.rootdir comes from the legacypath plugin on pytest >= 7
+    return str(getattr(config, 'rootpath', None) or config.rootdir)
+
+
+def _is_distributed(config):
+    """Whether tests are run by pytest-xdist workers."""
+    return (hasattr(config, 'workerinput') or
+            hasattr(config, 'slaveinput') or
+            getattr(config.option, 'dist', 'no') != 'no' or
+            bool(getattr(config.option, 'numprocesses', None)))
+
+
+def _other_protocols(item, plugin):
+    """Whether a plugin other than pytest and `plugin` runs tests with its
+    own `pytest_runtest_protocol`, e.g. to rerun flaky tests.
+    """
+    hook = item.ihook.pytest_runtest_protocol
+    for impl in hook.get_hookimpls():
+        if (impl.hookwrapper or getattr(impl, 'wrapper', False) or
+                impl.plugin is plugin):
+            continue
+        module = getattr(impl.function, '__module__', None) or ''
+        if not module.startswith('_pytest.'):
+            return True
+    return False
+
+
+def _is_pytest_fixture(fixturedefs):
+    """Whether the last of `fixturedefs` is a fixture of pytest itself.
+
+    Names without fixture definitions, such as ``request``, count as
+    pytest's.
+    """
+    if not fixturedefs:
+        return True
+    module = getattr(fixturedefs[-1].func, '__module__', None) or ''
+    return module.startswith('_pytest.')
+
+
+def _has_params(item):
+    """Whether a fixture used by `item` is parametrized."""
+    name2fixturedefs = getattr(getattr(item, '_fixtureinfo', None),
+                               'name2fixturedefs', {})
+    return any(fixturedefs and fixturedefs[-1].params
+               for fixturedefs in name2fixturedefs.values())
+
+
+def _describe_sources(sources):
+    parts = []
+    for name, data in sources.items():
+        if data['source'] == 'call':
+            parts.append("%s in call" % (name,))
+        elif data['fixtures']:
+            parts.append("%s in setup/teardown of fixture %s" % (
+                name, ", ".join(repr(fixture)
+                                for fixture in data['fixtures'])))
+        else:
+            parts.append("%s in setup/teardown" % (name,))
+    return "; ".join(parts)
+
+
+def hunt_leaks(func, nwarmup, ntracked, **options):
+    """Run `func` repeatedly and return the leaks found.
+
+    Extra `options` are passed on to the refleak engine (Python >= 3.7):
+    `deltas` collects the raw tracked deltas per counter, `allowance`
+    gives the per-counter noise to discount, `warm_caches=False`
+    skips the per-call cache warming, `counters` lists extra
+    ``(name, sample, checker)`` counters, `guard` is called after
+    every repetition, `cleanups` are called between repetitions,
+    `batch` runs `func` that many times per repetition, and `settle`
+    ends the warm-up once the counters stop moving (Python >= 3.11).
+    """
     huntrleaks = (nwarmup, ntracked, "")
     if refleak_ver == '27':
         return refleak.dash_R(None, "", func, huntrleaks, True)
@@ -255,4 +2078,19 @@ def hunt_leaks(func, nwarmup, ntracked):
         ns = Namespace()
         ns.quiet = True
         ns.huntrleaks = huntrleaks
+        ns.__dict__.update(options)
         return refleak.dash_R(ns, "", func)
+
+
+def measure(func, repeat=4, warmup=5, **options):
+    """Hunt leaks in a single callable and return a `Measurement`.
+
+    `func` is called `warmup` times, then `repeat` more times with the
+    counters sampled in between, with the cleanup of the refleak engine
+    after every call.  Extra `options` are those of `hunt_leaks`.
+    """
+    deltas = OrderedDict()
+    if refleak_ver not in ('27', '35'):
+        options['deltas'] = deltas
+    leaks = hunt_leaks(func, warmup, repeat, **options)
+    return Measurement(deltas, Leaks(leaks))
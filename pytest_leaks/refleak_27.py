@@ -90,8 +90,12 @@ def dash_R(the_module, test, indirect_test, huntrleaks, quiet):
 
     dash_R_cleanup(fs, ps, pic, zdc, abcs)
 
-    # initialize variables to make pyflakes quiet
-    rc_before = fd_before = 0
+    # <pytest-leaks edit>
+    # Baseline samples, so that the first repetition has real deltas
+    # even without warm-up
+    rc_before = sys.gettotalrefcount()
+    fd_before = support.fd_count()
+    # </pytest-leaks edit>
 
     for i in rep_range:
         run_the_test()
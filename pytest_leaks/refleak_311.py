@@ -0,0 +1,449 @@
+# Modified from cpython/Lib/test/libregrtest/refleak.py and utils.py (3.13)
+import os
+import re
+import sys
+import warnings
+from inspect import isabstract
+from . import support  # <- pytest-leaks edit
+from array import array  # <- pytest-leaks edit
+from collections import OrderedDict  # <- pytest-leaks edit
+try:
+    from _abc import _get_dump
+except ImportError:
+    import weakref
+
+    def _get_dump(cls):
+        # Reimplement _get_dump() for pure-Python implementation of
+        # the abc module (Lib/_py_abc.py)
+        registry_weakrefs = set(weakref.ref(obj) for obj in cls._abc_registry)
+        return (registry_weakrefs, cls._abc_cache,
+                cls._abc_negative_cache, cls._abc_negative_cache_version)
+
+
+def dash_R(ns, test_name, test_func):
+    """Run a test multiple times, looking for reference leaks.
+
+    Returns:
+        False if the test didn't leak references; True if we detected refleaks.
+    """
+    # This code is hackish and inelegant, but it seems to do the job.
+    import copyreg
+    import collections.abc
+
+    if not hasattr(sys, 'gettotalrefcount'):
+        raise Exception("Tracking reference leaks requires a debug build "
+                        "of Python")
+
+    # Avoid false positives due to various caches
+    # filling slowly with random data:
+    if getattr(ns, 'warm_caches', True):  # <- pytest-leaks edit
+        warm_caches()
+
+    # Save current values for dash_R_cleanup() to restore.
+    fs = warnings.filters[:]
+    ps = copyreg.dispatch_table.copy()
+    pic = sys.path_importer_cache.copy()
+    try:
+        import zipimport
+    except ImportError:
+        zdc = None # Run unmodified on platforms without zipimport support
+    else:
+        zdc = zipimport._zip_directory_cache.copy()
+    abcs = {}
+    for abc in [getattr(collections.abc, a) for a in collections.abc.__all__]:
+        if not isabstract(abc):
+            continue
+        for obj in abc.__subclasses__() + [abc]:
+            abcs[obj] = _get_dump(obj)[0]
+
+    nwarmup, ntracked, fname = ns.huntrleaks
+    fname = os.path.join(support.SAVEDCWD, fname)
+    repcount = nwarmup + ntracked
+
+    # These checkers return False on success, True on failure
+    def check_rc_deltas(deltas):
+        # Checker for reference counters and memomry blocks.
+        #
+        # bpo-30776: Try to ignore false positives:
+        #
+        #   [3, 0, 0]
+        #   [0, 1, 0]
+        #   [8, -8, 1]
+        #
+        # Expected leaks:
+        #
+        #   [5, 5, 6]
+        #   [10, 1, 1]
+        return all(delta >= 1 for delta in deltas)
+
+    def check_fd_deltas(deltas):
+        return any(deltas)
+
+    # Also, readjust the reference counts and alloc blocks by ignoring
+    # any strings that might have been interned during test_func (see
+    # references() and memory_blocks()). These strings will be
+    # deallocated at runtime shutdown
+
+    # <pytest-leaks edit>
+    # All counters as (name, sample, checker), the built-in ones first,
+    # followed by ``ns.counters``.  Samples and deltas go into arrays
+    # allocated up front, so that the loop doesn't allocate anything new
+    # however many counters there are (this replaces the bpo-31217
+    # integer pool).  Memory blocks are sampled first, immediately after
+    # the garbage collection.  ``ns.guard`` is called after every
+    # repetition and may abort the hunt, and ``ns.cleanups`` are called
+    # by dash_R_cleanup().
+    counters = [
+        ('references', references, check_rc_deltas),
+        ('memory blocks', memory_blocks, check_rc_deltas),
+        ('file descriptors', support.fd_count, check_fd_deltas),
+    ] + list(getattr(ns, 'counters', ()))
+    sample_order = [1, 0] + list(range(2, len(counters)))
+    samplers = [sample for name, sample, checker in counters]
+    samples_before = array('q', [0]) * len(counters)
+    counter_deltas = [array('q', [0]) * repcount for counter in counters]
+    guard = getattr(ns, 'guard', None)
+    cleanups = list(getattr(ns, 'cleanups', ()))
+    # ``ns.batch`` calls of test_func per repetition: deltas are divided
+    # by it, rounding towards zero, so noise smaller than a batch drops.
+    batch = getattr(ns, 'batch', 1)
+    batch_range = list(range(batch))
+    # With ``ns.settle``, warming up stops early, once two consecutive
+    # warm-up repetitions left all the counters unchanged; the tracked
+    # repetitions start at ``first_tracked``.
+    settle = getattr(ns, 'settle', False)
+    first_tracked = nwarmup
+    # </pytest-leaks edit>
+
+    # Pre-allocate to ensure that the loop doesn't allocate anything new
+    rep_range = list(range(repcount))
+
+    if not ns.quiet:
+        print("beginning", repcount, "repetitions", file=sys.stderr)
+        print(("1234567890"*(repcount//10 + 1))[:repcount], file=sys.stderr,
+              flush=True)
+
+    dash_R_cleanup(fs, ps, pic, zdc, abcs, cleanups)  # <- pytest-leaks edit
+    # <pytest-leaks edit>
+    # Baseline samples, so that the first repetition has real deltas
+    # even without warm-up
+    for j in sample_order:
+        samples_before[j] = samplers[j]()
+    # </pytest-leaks edit>
+
+    for i in rep_range:
+        for j in batch_range:  # <- pytest-leaks edit
+            test_func()
+        dash_R_cleanup(fs, ps, pic, zdc, abcs, cleanups)  # <- pytest-leaks edit
+
+        # dash_R_cleanup() ends with collecting cyclic trash:
+        # read memory statistics immediately after.
+        # <pytest-leaks edit>
+        for j in sample_order:
+            value = samplers[j]()
+            counter_deltas[j][i] = value - samples_before[j]
+            samples_before[j] = value
+        if guard is not None:
+            guard()
+        if (settle and 2 <= i < first_tracked - 1 and
+                not any(deltas[i] or deltas[i - 1]
+                        for deltas in counter_deltas)):
+            first_tracked = i + 1
+        # </pytest-leaks edit>
+
+        if not ns.quiet:
+            print('.', end='', file=sys.stderr, flush=True)
+
+        # <pytest-leaks edit>
+        if i + 1 >= first_tracked + ntracked:
+            break
+        # </pytest-leaks edit>
+
+    if not ns.quiet:
+        print(file=sys.stderr)
+
+    failed = False
+    leaks = OrderedDict()  # <- pytest-leaks edit
+    # <pytest-leaks edit>
+    # Raw tracked deltas are handed back through ``ns.deltas`` and the
+    # background noise in ``ns.allowance`` is discounted before checking.
+    # ``ns.checker``, if set, replaces the checker of every counter.
+    raw_deltas = getattr(ns, 'deltas', None)
+    allowance = getattr(ns, 'allowance', None) or {}
+    for deltas, (item_name, sample, checker) in zip(counter_deltas, counters):
+        # ignore warmup runs
+        deltas = list(deltas[first_tracked:first_tracked + ntracked])
+        if batch > 1:
+            deltas = [per_call_delta(delta, batch) for delta in deltas]
+        if raw_deltas is not None:
+            raw_deltas[item_name] = deltas
+        noise = allowance.get(item_name, 0)
+        if noise:
+            deltas = [discount_noise(delta, noise) for delta in deltas]
+        checker = getattr(ns, 'checker', None) or checker
+        # </pytest-leaks edit>
+        if checker(deltas):
+            # <pytest-leaks edit>
+            leaks[item_name] = deltas
+            continue
+            # </pytest-leaks edit>
+            msg = '%s leaked %s %s, sum=%s' % (
+                test_name, deltas, item_name, sum(deltas))
+            print(msg, file=sys.stderr, flush=True)
+            with open(fname, "a") as refrep:
+                print(msg, file=refrep)
+                refrep.flush()
+            failed = True
+    return leaks  # <- pytest-leaks edit
+
+
+# <pytest-leaks edit>
+def per_call_delta(delta, batch):
+    # Round towards zero, so that shrinkage doesn't turn into growth
+    if delta >= 0:
+        return delta // batch
+    return -(-delta // batch)
+
+
+def discount_noise(delta, noise):
+    # Growth up to the calibrated noise level is not counted as a leak;
+    # shrinkage is left alone.
+    if delta > noise:
+        return delta - noise
+    return min(delta, 0)
+# </pytest-leaks edit>
+
+
+# <pytest-leaks edit>
+def save_state():
+    """Return the state for dash_R_cleanup() to restore, as dash_R() does."""
+    import copyreg
+    import collections.abc
+
+    fs = warnings.filters[:]
+    ps = copyreg.dispatch_table.copy()
+    pic = sys.path_importer_cache.copy()
+    try:
+        import zipimport
+    except ImportError:
+        zdc = None
+    else:
+        zdc = zipimport._zip_directory_cache.copy()
+    abcs = {}
+    for abc in [getattr(collections.abc, a) for a in collections.abc.__all__]:
+        if not isabstract(abc):
+            continue
+        for obj in abc.__subclasses__() + [abc]:
+            abcs[obj] = _get_dump(obj)[0]
+    return fs, ps, pic, zdc, abcs
+
+
+def references():
+    """Return the total reference count, as dash_R() samples it."""
+    if (hasattr(sys, 'getunicodeinternedsize') and
+            sys.version_info < (3, 13)):
+        return sys.gettotalrefcount() - sys.getunicodeinternedsize() * 2
+    return sys.gettotalrefcount()
+
+
+def memory_blocks():
+    """Return the allocated memory blocks, as dash_R() samples them."""
+    getunicodeinternedsize = getattr(sys, 'getunicodeinternedsize', None)
+    if getunicodeinternedsize is None:
+        return sys.getallocatedblocks()
+    if sys.version_info >= (3, 13):
+        return sys.getallocatedblocks() - getunicodeinternedsize(
+            _only_immortal=True)
+    return sys.getallocatedblocks() - getunicodeinternedsize()
+# </pytest-leaks edit>
+
+
+def dash_R_cleanup(fs, ps, pic, zdc, abcs, cleanups=()):  # <- pytest-leaks edit
+    import copyreg
+    import collections.abc
+
+    # Restore some original values.
+    warnings.filters[:] = fs
+    copyreg.dispatch_table.clear()
+    copyreg.dispatch_table.update(ps)
+    sys.path_importer_cache.clear()
+    sys.path_importer_cache.update(pic)
+    try:
+        import zipimport
+    except ImportError:
+        pass # Run unmodified on platforms without zipimport support
+    else:
+        zipimport._zip_directory_cache.clear()
+        zipimport._zip_directory_cache.update(zdc)
+
+    # clear type cache and other internal caches
+    if hasattr(sys, '_clear_internal_caches'):
+        sys._clear_internal_caches()
+    else:
+        sys._clear_type_cache()
+
+    # Clear ABC registries, restoring previously saved ABC registries.
+    abs_classes = [getattr(collections.abc, a) for a in collections.abc.__all__]
+    abs_classes = filter(isabstract, abs_classes)
+    for abc in abs_classes:
+        for obj in abc.__subclasses__() + [abc]:
+            for ref in abcs.get(obj, set()):
+                if ref() is not None:
+                    obj.register(ref())
+            obj._abc_caches_clear()
+
+    # <pytest-leaks edit>
+    # Extra cleanups from ``ns.cleanups``, before the final collection
+    for cleanup in cleanups:
+        cleanup()
+    # </pytest-leaks edit>
+
+    clear_caches()
+
+
+def clear_caches():
+    # Clear the warnings registry, so they can be displayed again
+    for mod in sys.modules.values():
+        if hasattr(mod, '__warningregistry__'):
+            del mod.__warningregistry__
+
+    # Flush standard output, so that buffered data is sent to the OS and
+    # associated Python objects are reclaimed.
+    for stream in (sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__):
+        if stream is not None:
+            stream.flush()
+
+    # Clear assorted module caches.
+    # Don't worry about resetting the cache if the module is not loaded
+    try:
+        distutils_dir_util = sys.modules['distutils.dir_util']
+    except KeyError:
+        pass
+    else:
+        distutils_dir_util._path_created.clear()
+    re.purge()
+
+    try:
+        _strptime = sys.modules['_strptime']
+    except KeyError:
+        pass
+    else:
+        _strptime._regex_cache.clear()
+
+    try:
+        urllib_parse = sys.modules['urllib.parse']
+    except KeyError:
+        pass
+    else:
+        urllib_parse.clear_cache()
+
+    try:
+        urllib_request = sys.modules['urllib.request']
+    except KeyError:
+        pass
+    else:
+        urllib_request.urlcleanup()
+
+    try:
+        linecache = sys.modules['linecache']
+    except KeyError:
+        pass
+    else:
+        linecache.clearcache()
+
+    try:
+        mimetypes = sys.modules['mimetypes']
+    except KeyError:
+        pass
+    else:
+        mimetypes._default_mime_types()
+
+    try:
+        filecmp = sys.modules['filecmp']
+    except KeyError:
+        pass
+    else:
+        filecmp._cache.clear()
+
+    try:
+        struct = sys.modules['struct']
+    except KeyError:
+        pass
+    else:
+        struct._clearcache()
+
+    try:
+        doctest = sys.modules['doctest']
+    except KeyError:
+        pass
+    else:
+        doctest.master = None
+
+    try:
+        ctypes = sys.modules['ctypes']
+    except KeyError:
+        pass
+    else:
+        ctypes._reset_cache()
+
+    # <pytest-leaks edit>
+    try:
+        asyncio_coroutines = sys.modules['asyncio.coroutines']
+    except KeyError:
+        pass
+    else:
+        typecache = getattr(asyncio_coroutines, '_iscoroutine_typecache', None)
+        if typecache is not None:
+            typecache.clear()
+    # </pytest-leaks edit>
+
+    try:
+        typing = sys.modules['typing']
+    except KeyError:
+        pass
+    else:
+        for f in typing._cleanups:
+            f()
+
+    try:
+        fractions = sys.modules['fractions']
+    except KeyError:
+        pass
+    else:
+        hash_algorithm = getattr(fractions, '_hash_algorithm', None)
+        if hash_algorithm is not None:
+            hash_algorithm.cache_clear()
+
+    try:
+        inspect = sys.modules['inspect']
+    except KeyError:
+        pass
+    else:
+        shadowed_dict = getattr(
+            inspect, '_shadowed_dict_from_weakref_mro_tuple', None)
+        if shadowed_dict is not None:
+            shadowed_dict.cache_clear()
+        inspect._filesbymodname.clear()
+        inspect.modulesbyfile.clear()
+
+    try:
+        importlib_metadata = sys.modules['importlib.metadata']
+    except KeyError:
+        pass
+    else:
+        fast_path = getattr(importlib_metadata, 'FastPath', None)
+        if hasattr(getattr(fast_path, '__new__', None), 'cache_clear'):
+            fast_path.__new__.cache_clear()
+
+    support.gc_collect()
+
+
+def warm_caches():
+    # char cache
+    s = bytes(range(256))
+    for i in range(256):
+        s[i:i+1]
+    # unicode cache
+    [chr(i) for i in range(256)]
+    # int cache
+    list(range(-5, 257))
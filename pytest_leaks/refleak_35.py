@@ -78,6 +78,7 @@ def dash_R(the_module, test, indirect_test, huntrleaks):
     #print("beginning", repcount, "repetitions", file=sys.stderr)  # <- pytest-leaks edit
     #print(("1234567890"*(repcount//10 + 1))[:repcount], file=sys.stderr)  # <- pytest-leaks edit
     sys.stderr.flush()
+    alloc_before, rc_before = dash_R_cleanup(fs, ps, pic, zdc, abcs)  # <- pytest-leaks edit
     for i in range(repcount):
         indirect_test()
         alloc_after, rc_after = dash_R_cleanup(fs, ps, pic, zdc, abcs)
@@ -5,6 +5,7 @@ import sys
 import warnings
 from inspect import isabstract
 from . import support  # <- pytest-leaks edit
+from array import array  # <- pytest-leaks edit
 from collections import OrderedDict  # <- pytest-leaks edit
 try:
     from _abc import _get_dump
@@ -35,7 +36,8 @@ def dash_R(ns, test_name, test_func):
 
     # Avoid false positives due to various caches
     # filling slowly with random data:
-    warm_caches()
+    if getattr(ns, 'warm_caches', True):  # <- pytest-leaks edit
+        warm_caches()
 
     # Save current values for dash_R_cleanup() to restore.
     fs = warnings.filters[:]
@@ -54,89 +56,113 @@ def dash_R(ns, test_name, test_func):
         for obj in abc.__subclasses__() + [abc]:
             abcs[obj] = _get_dump(obj)[0]
 
-    # bpo-31217: Integer pool to get a single integer object for the same
-    # value. The pool is used to prevent false alarm when checking for memory
-    # block leaks. Fill the pool with values in -1000..1000 which are the most
-    # common (reference, memory block, file descriptor) differences.
-    int_pool = {value: value for value in range(-1000, 1000)}
-    def get_pooled_int(value):
-        return int_pool.setdefault(value, value)
-
     nwarmup, ntracked, fname = ns.huntrleaks
     fname = os.path.join(support.SAVEDCWD, fname)
     repcount = nwarmup + ntracked
 
+    # These checkers return False on success, True on failure
+    def check_rc_deltas(deltas):
+        # Checker for reference counters and memomry blocks.
+        #
+        # bpo-30776: Try to ignore false positives:
+        #
+        #   [3, 0, 0]
+        #   [0, 1, 0]
+        #   [8, -8, 1]
+        #
+        # Expected leaks:
+        #
+        #   [5, 5, 6]
+        #   [10, 1, 1]
+        return all(delta >= 1 for delta in deltas)
+
+    def check_fd_deltas(deltas):
+        return any(deltas)
+
+    # <pytest-leaks edit>
+    # All counters as (name, sample, checker), the built-in ones first,
+    # followed by ``ns.counters``.  Samples and deltas go into arrays
+    # allocated up front, so that the loop doesn't allocate anything new
+    # however many counters there are (this replaces the bpo-31217
+    # integer pool).  Memory blocks are sampled first, immediately after
+    # the garbage collection.  ``ns.guard`` is called after every
+    # repetition and may abort the hunt, and ``ns.cleanups`` are called
+    # by dash_R_cleanup().
+    counters = [
+        ('references', sys.gettotalrefcount, check_rc_deltas),
+        ('memory blocks', sys.getallocatedblocks, check_rc_deltas),
+        ('file descriptors', support.fd_count, check_fd_deltas),
+    ] + list(getattr(ns, 'counters', ()))
+    sample_order = [1, 0] + list(range(2, len(counters)))
+    samplers = [sample for name, sample, checker in counters]
+    samples_before = array('q', [0]) * len(counters)
+    counter_deltas = [array('q', [0]) * repcount for counter in counters]
+    guard = getattr(ns, 'guard', None)
+    cleanups = list(getattr(ns, 'cleanups', ()))
+    # ``ns.batch`` calls of test_func per repetition: deltas are divided
+    # by it, rounding towards zero, so noise smaller than a batch drops.
+    batch = getattr(ns, 'batch', 1)
+    batch_range = list(range(batch))
+    # </pytest-leaks edit>
+
     # Pre-allocate to ensure that the loop doesn't allocate anything new
     rep_range = list(range(repcount))
-    rc_deltas = [0] * repcount
-    alloc_deltas = [0] * repcount
-    fd_deltas = [0] * repcount
-    getallocatedblocks = sys.getallocatedblocks
-    gettotalrefcount = sys.gettotalrefcount
-    fd_count = support.fd_count
-
-    # initialize variables to make pyflakes quiet
-    rc_before = alloc_before = fd_before = 0
 
     if not ns.quiet:
         print("beginning", repcount, "repetitions", file=sys.stderr)
         print(("1234567890"*(repcount//10 + 1))[:repcount], file=sys.stderr,
               flush=True)
 
-    dash_R_cleanup(fs, ps, pic, zdc, abcs)
+    dash_R_cleanup(fs, ps, pic, zdc, abcs, cleanups)  # <- pytest-leaks edit
+    # <pytest-leaks edit>
+    # Baseline samples, so that the first repetition has real deltas
+    # even without warm-up
+    for j in sample_order:
+        samples_before[j] = samplers[j]()
+    # </pytest-leaks edit>
 
     for i in rep_range:
-        test_func()
-        dash_R_cleanup(fs, ps, pic, zdc, abcs)
+        for j in batch_range:  # <- pytest-leaks edit
+            test_func()
+        dash_R_cleanup(fs, ps, pic, zdc, abcs, cleanups)  # <- pytest-leaks edit
 
         # dash_R_cleanup() ends with collecting cyclic trash:
         # read memory statistics immediately after.
-        alloc_after = getallocatedblocks()
-        rc_after = gettotalrefcount()
-        fd_after = fd_count()
+        # <pytest-leaks edit>
+        for j in sample_order:
+            value = samplers[j]()
+            counter_deltas[j][i] = value - samples_before[j]
+            samples_before[j] = value
+        if guard is not None:
+            guard()
+        # </pytest-leaks edit>
 
         if not ns.quiet:
             print('.', end='', file=sys.stderr, flush=True)
 
-        rc_deltas[i] = get_pooled_int(rc_after - rc_before)
-        alloc_deltas[i] = get_pooled_int(alloc_after - alloc_before)
-        fd_deltas[i] = get_pooled_int(fd_after - fd_before)
-
-        alloc_before = alloc_after
-        rc_before = rc_after
-        fd_before = fd_after
-
     if not ns.quiet:
         print(file=sys.stderr)
 
-    # These checkers return False on success, True on failure
-    def check_rc_deltas(deltas):
-        # Checker for reference counters and memomry blocks.
-        #
-        # bpo-30776: Try to ignore false positives:
-        #
-        #   [3, 0, 0]
-        #   [0, 1, 0]
-        #   [8, -8, 1]
-        #
-        # Expected leaks:
-        #
-        #   [5, 5, 6]
-        #   [10, 1, 1]
-        return all(delta >= 1 for delta in deltas)
-
-    def check_fd_deltas(deltas):
-        return any(deltas)
-
     failed = False
     leaks = OrderedDict()  # <- pytest-leaks edit
-    for deltas, item_name, checker in [
-        (rc_deltas, 'references', check_rc_deltas),
-        (alloc_deltas, 'memory blocks', check_rc_deltas),
-        (fd_deltas, 'file descriptors', check_fd_deltas)
-    ]:
+    # <pytest-leaks edit>
+    # Raw tracked deltas are handed back through ``ns.deltas`` and the
+    # background noise in ``ns.allowance`` is discounted before checking.
+    # ``ns.checker``, if set, replaces the checker of every counter.
+    raw_deltas = getattr(ns, 'deltas', None)
+    allowance = getattr(ns, 'allowance', None) or {}
+    for deltas, (item_name, sample, checker) in zip(counter_deltas, counters):
         # ignore warmup runs
-        deltas = deltas[nwarmup:]
+        deltas = list(deltas[nwarmup:])
+        if batch > 1:
+            deltas = [per_call_delta(delta, batch) for delta in deltas]
+        if raw_deltas is not None:
+            raw_deltas[item_name] = deltas
+        noise = allowance.get(item_name, 0)
+        if noise:
+            deltas = [discount_noise(delta, noise) for delta in deltas]
+        checker = getattr(ns, 'checker', None) or checker
+        # </pytest-leaks edit>
         if checker(deltas):
             # <pytest-leaks edit>
             leaks[item_name] = deltas
@@ -152,7 +178,59 @@ def dash_R(ns, test_name, test_func):
     return leaks  # <- pytest-leaks edit
 
 
-def dash_R_cleanup(fs, ps, pic, zdc, abcs):
+# <pytest-leaks edit>
+def per_call_delta(delta, batch):
+    # Round towards zero, so that shrinkage doesn't turn into growth
+    if delta >= 0:
+        return delta // batch
+    return -(-delta // batch)
+
+
+def discount_noise(delta, noise):
+    # Growth up to the calibrated noise level is not counted as a leak;
+    # shrinkage is left alone.
+    if delta > noise:
+        return delta - noise
+    return min(delta, 0)
+# </pytest-leaks edit>
+
+
+# <pytest-leaks edit>
+def save_state():
+    """Return the state for dash_R_cleanup() to restore, as dash_R() does."""
+    import copyreg
+    import collections.abc
+
+    fs = warnings.filters[:]
+    ps = copyreg.dispatch_table.copy()
+    pic = sys.path_importer_cache.copy()
+    try:
+        import zipimport
+    except ImportError:
+        zdc = None
+    else:
+        zdc = zipimport._zip_directory_cache.copy()
+    abcs = {}
+    for abc in [getattr(collections.abc, a) for a in collections.abc.__all__]:
+        if not isabstract(abc):
+            continue
+        for obj in abc.__subclasses__() + [abc]:
+            abcs[obj] = _get_dump(obj)[0]
+    return fs, ps, pic, zdc, abcs
+
+
+def references():
+    """Return the total reference count, as dash_R() samples it."""
+    return sys.gettotalrefcount()
+
+
+def memory_blocks():
+    """Return the allocated memory blocks, as dash_R() samples them."""
+    return sys.getallocatedblocks()
+# </pytest-leaks edit>
+
+
+def dash_R_cleanup(fs, ps, pic, zdc, abcs, cleanups=()):  # <- pytest-leaks edit
     import copyreg
     import collections.abc
 
@@ -183,6 +261,12 @@ def dash_R_cleanup(fs, ps, pic, zdc, abcs):
                     obj.register(ref())
             obj._abc_caches_clear()
 
+    # <pytest-leaks edit>
+    # Extra cleanups from ``ns.cleanups``, before the final collection
+    for cleanup in cleanups:
+        cleanup()
+    # </pytest-leaks edit>
+
     clear_caches()
 
 
@@ -271,6 +355,17 @@ def clear_caches():
     else:
         ctypes._reset_cache()
 
+    # <pytest-leaks edit>
+    try:
+        asyncio_coroutines = sys.modules['asyncio.coroutines']
+    except KeyError:
+        pass
+    else:
+        typecache = getattr(asyncio_coroutines, '_iscoroutine_typecache', None)
+        if typecache is not None:
+            typecache.clear()
+    # </pytest-leaks edit>
+
     try:
         typing = sys.modules['typing']
     except KeyError:
@@ -0,0 +1,204 @@
+"""
+A warm interpreter serving leak hunts over a local socket.
+
+Starting a debug build of Python and importing a large application can
+take much longer than hunting the leaks of a single test.  The server
+pays for it once: it imports pytest and the ``--preload`` modules, then
+forks a child for every request, which runs pytest with the requested
+arguments on a copy of the warm interpreter and streams its output back.
+Test modules are only ever imported in the children, so they are always
+fresh; preloaded modules whose source changed are reloaded in the server
+before forking.
+
+Usage::
+
+    python -m pytest_leaks.server serve --socket /tmp/leaks.sock \\
+        --preload myapp
+    python -m pytest_leaks.server run --socket /tmp/leaks.sock -- \\
+        -R : tests/test_foo.py::test_bar
+"""
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import os
+import socket
+import sys
+import traceback
+
+try:
+    from importlib import reload
+except ImportError:
+    pass  # Python 2: builtin
+
+
+# Written by the server after the output of a request, followed by the
+# exit status of pytest.
+EXIT_MARKER = b'\0pytest-leaks-exit:'
+
+
+def _module_mtimes(root):
+    mtimes = {}
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, '__file__', None)
+        if not filename or not os.path.abspath(filename).startswith(root):
+            continue
+        try:
+            mtimes[name] = os.stat(filename).st_mtime
+        except OSError:
+            pass
+    return mtimes
+
+
+class LeaksServer(object):
+    def __init__(self, path, preload=()):
+        self.path = path
+        self.root = os.path.join(os.path.abspath(os.getcwd()), '')
+
+        # pytest_leaks.plugin itself is left to the children, so that
+        # pytest can still rewrite its asserts
+        import pytest  # noqa: F401
+        for name in preload:
+            importlib.import_module(name)
+
+        self.mtimes = _module_mtimes(self.root)
+
+    def reload_changed(self):
+        """Reload the preloaded modules whose source file changed."""
+        for name, mtime in sorted(_module_mtimes(self.root).items()):
+            if name in self.mtimes and self.mtimes[name] != mtime:
+                module = sys.modules.get(name)
+                if module is not None:
+                    reload(module)
+        self.mtimes = _module_mtimes(self.root)
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(1)
+        print("pytest-leaks: serving on %s" % (self.path,), file=sys.stderr)
+        try:
+            while True:
+                conn, _ = listener.accept()
+                try:
+                    self.handle(conn, listener)
+                finally:
+                    conn.close()
+        finally:
+            listener.close()
+            os.unlink(self.path)
+
+    def handle(self, conn, listener):
+        request = json.loads(conn.makefile('rb').readline().decode('utf-8'))
+        self.reload_changed()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            # Child: run pytest with its output going to the client
+            status = 3
+            try:
+                listener.close()
+                os.dup2(conn.fileno(), 1)
+                os.dup2(conn.fileno(), 2)
+                os.chdir(request.get('cwd') or self.root)
+                import pytest
+                status = int(pytest.main(list(request['args'])))
+            except BaseException:
+                # Show the client why, before _exit() loses it
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        if os.WIFEXITED(status):
+            code = os.WEXITSTATUS(status)
+        else:
+            code = 128 + os.WTERMSIG(status)
+        conn.sendall(EXIT_MARKER + str(code).encode('ascii') + b'\n')
+
+
+def run(path, args, out=None):
+    """Send a request to the server at `path` and stream its output.
+
+    Returns the exit status of pytest.
+    """
+    if out is None:
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    try:
+        request = {'args': list(args), 'cwd': os.getcwd()}
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+        pending = b''
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            pending += data
+            # Keep a possibly incomplete marker back
+            marker = pending.find(EXIT_MARKER)
+            if marker < 0:
+                keep = len(EXIT_MARKER)
+                out.write(pending[:-keep])
+                pending = pending[-keep:]
+            else:
+                out.write(pending[:marker])
+                pending = pending[marker:]
+            out.flush()
+    finally:
+        client.close()
+
+    if not pending.startswith(EXIT_MARKER):
+        out.write(pending)
+        out.flush()
+        return 3
+    return int(pending[len(EXIT_MARKER):].strip() or 3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pytest_leaks.server',
+        description='Keep a warm interpreter to run leak hunts in.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    serve_parser = subparsers.add_parser(
+        'serve', help='start the server')
+    serve_parser.add_argument('--socket', required=True,
+                              help='path of the Unix socket to listen on')
+    serve_parser.add_argument('--preload', action='append', default=[],
+                              metavar='MODULE',
+                              help='module to import once in the server')
+
+    run_parser = subparsers.add_parser(
+        'run', help='run pytest in the server')
+    run_parser.add_argument('--socket', required=True,
+                            help='path of the Unix socket of the server')
+    run_parser.add_argument('args', nargs=argparse.REMAINDER,
+                            help='pytest arguments, e.g. -R : NODEID')
+
+    options = parser.parse_args(argv)
+    if options.command == 'serve':
+        if not hasattr(os, 'fork') or not hasattr(socket, 'AF_UNIX'):
+            parser.error("the server requires fork() and Unix sockets")
+        LeaksServer(options.socket, options.preload).serve_forever()
+    elif options.command == 'run':
+        args = options.args
+        if args[:1] == ['--']:
+            args = args[1:]
+        return run(options.socket, args)
+    else:
+        parser.print_help()
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import sys
 
 import pytest
@@ -320,3 +321,1417 @@ def test_marker_skip_leaks(testdir):
         "*::test_leaking_noskip: leaked references*",
         "*::test_leaking_skip_fail: leaked*something*",
     ])
+
+
+def test_calibrate(testdir):
+    test_code = """
+    garbage = []
+
+    def test_refleaks():
+        garbage.extend([None] * 100)
+
+    def test_noleak():
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-calibrate', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_refleaks LEAKED*',
+        '*::test_noleak PASSED*',
+        '*leaks calibration*',
+        'harness noise per repetition: references: *',
+        '*leaks summary*',
+        '*::test_refleaks: leaked references*',
+    ])
+    assert result.ret == 0
+
+
+def test_calibrate_autouse(testdir):
+    testdir.makeconftest("""
+    import pytest
+
+    registry = []
+
+    @pytest.fixture(autouse=True)
+    def leaky_autouse():
+        registry.extend([None] * 100)
+    """)
+
+    testdir.makepyfile("""
+    def test_a():
+        pass
+    """)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-calibrate', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_a LEAKED*',
+        '*leaks summary*',
+        '*::test_a: leaked references*',
+    ])
+    assert result.ret == 0
+
+
+def test_screen(testdir):
+    test_code = """
+    garbage = []
+
+    def test_refleaks():
+        garbage.extend([None] * 100)
+
+    def test_noleak():
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-screen', '1:2', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_refleaks LEAKED*',
+        '*::test_noleak PASSED*',
+        '*leaks summary*',
+        '*::test_refleaks: leaked references*',
+        '*leaks screening*',
+        '1 suspects after screening, 1 confirmed',
+        '*::test_refleaks: confirmed (screen leaked references: *',
+    ])
+    assert result.ret == 0
+
+
+def test_screen_option_parsing(testdir):
+    testdir.makepyfile("""
+        def test_screen(leaks_checker):
+            assert leaks_checker.screen == (1, 2)
+    """)
+    result = testdir.runpytest('-R', ':', '--leaks-screen', ':')
+    assert result.ret == 0
+
+
+def test_import_is_cheap():
+    import subprocess
+
+    code = (
+        "import subprocess, sys\n"
+        "import pytest\n"
+        "before = set(sys.modules)\n"
+        "def fail(*args, **kwargs):\n"
+        "    raise AssertionError('subprocess started')\n"
+        "subprocess.Popen = fail\n"
+        "import pytest_leaks.plugin\n"
+        "imported = set(sys.modules) - before\n"
+        "assert not imported & {'asyncio', 'ctypes'}, imported\n"
+    )
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='requires /proc and glibc')
+def test_memory_counters(testdir):
+    test_code = """
+    import ctypes
+
+    libc = ctypes.CDLL(None)
+    libc.malloc.restype = ctypes.c_void_p
+
+    def test_malloc_leak():
+        libc.malloc(1 << 20)
+
+    def test_noleak():
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-memory', '--leaks-memory-rate', '512K', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_malloc_leak LEAKED*',
+        '*::test_noleak PASSED*',
+        '*leaks summary*',
+        '*::test_malloc_leak: leaked *native heap bytes*',
+    ])
+    assert result.ret == 0
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='requires /proc and glibc')
+def test_memory_limit(testdir):
+    test_code = """
+    garbage = []
+
+    def test_memory_hog():
+        garbage.append(bytearray(64 << 20))
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-memory-limit', '256M', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*pytest-leaks: memory limit of 268435456 bytes exceeded*',
+    ])
+    assert result.ret == 1
+
+
+def test_counters_ini(testdir):
+    testdir.makeini("""
+        [pytest]
+        leaks_counters =
+            threads
+            tempfiles
+    """)
+
+    test_code = """
+    import tempfile
+    import threading
+
+    events = []
+
+    def test_tempfile_leak():
+        tempfile.NamedTemporaryFile(delete=False).close()
+
+    def test_thread_leak():
+        event = threading.Event()
+        events.append(event)
+        threading.Thread(target=event.wait, daemon=True).start()
+
+    def test_noleak():
+        pass
+
+    def teardown_module():
+        for event in events:
+            event.set()
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess('-R', ':', '-v')
+
+    result.stdout.fnmatch_lines([
+        '*::test_tempfile_leak LEAKED*',
+        '*::test_thread_leak LEAKED*',
+        '*::test_noleak PASSED*',
+        '*leaks summary*',
+        '*::test_tempfile_leak: leaked *temporary files: ?1, 1, 1, 1?',
+        '*::test_thread_leak: leaked *threads: *',
+    ])
+    assert result.ret == 0
+
+
+def test_counters_hook(testdir):
+    testdir.makeconftest("""
+        handles = []
+
+        def pytest_leaks_counters(config):
+            return [('handles', lambda: len(handles),
+                     lambda deltas: any(deltas))]
+    """)
+
+    test_code = """
+    from conftest import handles
+
+    def test_handle_leak():
+        handles.append(object())
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess('-R', ':', '-v')
+
+    result.stdout.fnmatch_lines([
+        '*::test_handle_leak LEAKED*',
+        '*leaks summary*',
+        '*::test_handle_leak: leaked *handles: *',
+    ])
+    assert result.ret == 0
+
+
+def test_counters_ini_invalid(testdir):
+    testdir.makeini("""
+        [pytest]
+        leaks_counters = nosuchcounter
+    """)
+
+    testdir.makepyfile("""
+        def test_sth():
+            pass
+    """)
+
+    result = testdir.runpytest('-R', ':')
+
+    result.stderr.fnmatch_lines([
+        "*invalid value for 'leaks_counters'*unknown counter*",
+    ])
+    assert result.ret != 0
+
+
+def test_phases(testdir):
+    test_code = """
+    import pytest
+
+    garbage = []
+
+    @pytest.fixture
+    def leaky_fixture():
+        garbage.extend([None] * 100)
+
+    @pytest.fixture
+    def clean_fixture():
+        yield []
+
+    def test_fixture_leak(leaky_fixture, clean_fixture):
+        pass
+
+    def test_call_leak(clean_fixture):
+        garbage.extend([None] * 100)
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess('-R', ':', '--leaks-phases', '-v')
+
+    result.stdout.fnmatch_lines([
+        '*::test_fixture_leak LEAKED*',
+        '*::test_call_leak LEAKED*',
+        '*leaks by phase*',
+        "*::test_fixture_leak: references in setup/teardown of fixture "
+        "'leaky_fixture'*",
+        "*::test_call_leak: references in call*",
+    ])
+    assert result.ret == 0
+
+
+def test_phases_class_and_params(testdir):
+    test_code = """
+    import pytest
+
+    garbage = []
+
+    class TestClass(object):
+        @pytest.fixture
+        def leaky_fixture(self):
+            garbage.extend([None] * 100)
+
+        def test_method(self, leaky_fixture):
+            pass
+
+    @pytest.fixture(params=[1, 2])
+    def leaky_param(request):
+        garbage.extend([None] * 100)
+        return request.param
+
+    def test_param(leaky_param):
+        pass
+
+    def test_after():
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess('-R', ':', '--leaks-phases', '-v')
+
+    result.stdout.fnmatch_lines([
+        '*::TestClass::test_method LEAKED*',
+        '*::test_param?1? LEAKED*',
+        '*::test_param?2? LEAKED*',
+        '*::test_after PASSED*',
+        '*leaks by phase*',
+        "*::TestClass::test_method: references in setup/teardown of "
+        "fixture 'leaky_fixture'*",
+        "*::test_param?1?: references in setup/teardown of fixture "
+        "'(unattributed)'*",
+    ])
+    assert 'ERROR' not in result.stdout.str()
+    assert result.ret == 0
+
+
+def test_families(testdir):
+    test_code = """
+    import pytest
+
+    garbage = []
+
+    @pytest.mark.parametrize('n', range(10))
+    def test_clean(n):
+        pass
+
+    @pytest.mark.parametrize('n', range(10))
+    def test_leaky(n):
+        garbage.extend([None] * 100)
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-families', '2', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*leaks families*',
+        '*::test_clean: 2 of 10 instances hunted',
+        '*::test_leaky: leaked, all 10 instances hunted',
+    ])
+    result.assert_outcomes(passed=10)
+    assert result.stdout.str().count('LEAKED') == 10
+    assert result.ret == 0
+
+
+def test_sample_rotation(testdir):
+    test_code = """
+    import pytest
+
+    garbage = []
+
+    @pytest.mark.parametrize('n', range(12))
+    def test_leaky(n):
+        garbage.extend([None] * 100)
+    """
+
+    testdir.makepyfile(test_code)
+
+    leaked = set()
+    for rotation in range(3):
+        result = testdir.runpytest_subprocess(
+            '-R', ':', '--leaks-sample', '1/3', '-v'
+        )
+        result.stdout.fnmatch_lines([
+            '*leaks sampling*',
+            'sample 1/3, rotation %d: hunted * of 12 tests' % (rotation,),
+            'every test is hunted at least once in any 3 consecutive runs',
+        ])
+        assert result.ret == 0
+        lines = [line for line in result.stdout.lines if 'LEAKED' in line]
+        assert leaked.isdisjoint(lines)
+        leaked.update(lines)
+
+    assert len(leaked) == 12
+
+
+def test_objects(testdir):
+    test_code = """
+    class Leaky(object):
+        pass
+
+    garbage = []
+
+    def test_leaky_object():
+        garbage.append(Leaky())
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-objects', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_leaky_object LEAKED*',
+        '*leaked objects*',
+        '*::test_leaky_object:',
+        '    Leaky <*Leaky object at *> '
+        '(referenced from test_objects.garbage*)',
+    ])
+    assert result.ret == 0
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'),
+                    reason='the server requires fork()')
+def test_server(testdir):
+    import subprocess
+    import time
+
+    test_code = """
+    garbage = []
+
+    def test_leaking():
+        garbage.extend([None] * 100)
+    """
+
+    testdir.makepyfile(test_code)
+    path = str(testdir.tmpdir.join('leaks.sock'))
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'pytest_leaks.server', 'serve',
+         '--socket', path],
+        cwd=str(testdir.tmpdir))
+    try:
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+
+        client = subprocess.Popen(
+            [sys.executable, '-m', 'pytest_leaks.server', 'run',
+             '--socket', path, '--', '-R', ':', '-v'],
+            cwd=str(testdir.tmpdir), stdout=subprocess.PIPE)
+        out = client.communicate()[0].decode('utf-8')
+    finally:
+        server.terminate()
+        server.wait()
+
+    assert '::test_leaking LEAKED' in out
+    assert client.returncode == 0
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'),
+                    reason='the server requires fork()')
+def test_server_error(testdir):
+    import json
+    import socket
+    import subprocess
+    import time
+
+    from pytest_leaks.server import EXIT_MARKER
+
+    path = str(testdir.tmpdir.join('leaks.sock'))
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'pytest_leaks.server', 'serve',
+         '--socket', path],
+        cwd=str(testdir.tmpdir))
+    try:
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        request = {'args': ['-R', ':'],
+                   'cwd': str(testdir.tmpdir.join('missing'))}
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        out = b''
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            out += data
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    out = out.decode('utf-8')
+    assert 'Traceback' in out
+    assert 'missing' in out
+    assert out.endswith(EXIT_MARKER.decode('ascii') + '3\n')
+
+
+_referrer_root = []
+
+
+def test_referrer_chain_max_visited():
+    from pytest_leaks import objects
+
+    obj = type('Leaked', (object,), {})()
+    _referrer_root.append([obj])
+    try:
+        assert objects.referrer_chain(obj).endswith('._referrer_root[0][0]')
+        assert objects.referrer_chain(obj, max_visited=1) is None
+    finally:
+        del _referrer_root[:]
+
+
+def test_leaks_python(testdir):
+    test_code = """
+    garbage = []
+
+    def test_leaking():
+        garbage.extend([None] * 100)
+
+    def test_failing():
+        assert False
+
+    def test_clean():
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-python=' + sys.executable, '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_leaking PASSED*',
+        '*::test_failing FAILED*',
+        '*leaks summary*',
+        '*::test_leaking: leaked references: *',
+        '*leaks delegate*',
+        '1 batches hunted on *',
+    ])
+    # The failure is reported once, by the normal run, and the leaking
+    # test is counted as leaked only
+    result.stdout.fnmatch_lines(['*= 1 failed, 1 passed, 1 leaked in *'])
+
+
+@pytest.mark.skipif(int(pytest.__version__.split('.')[0]) < 7,
+                    reason='the legacypath plugin requires pytest >= 7')
+def test_leaks_python_no_legacypath(testdir):
+    testdir.makepyfile(test_a="def test_a(): pass",
+                       test_b="def test_b(): pass")
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-python=' + sys.executable,
+        '-p', 'no:legacypath'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*leaks delegate*',
+        '2 batches hunted on *',
+    ])
+    assert result.ret == 0
+
+
+def test_leaks_python_invalid(testdir):
+    testdir.makepyfile("def test_sth(): pass")
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-python=/nonexistent/python'
+    )
+
+    result.stderr.fnmatch_lines([
+        '*pytest-leaks: --leaks-python must run a debug build of Python*',
+    ])
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='--leaks-asyncio requires Python >= 3.7')
+def test_asyncio(testdir):
+    test_code = """
+    import asyncio
+
+    loops = set()
+    pending = []
+
+    def test_loop_reused():
+        async def main():
+            return id(asyncio.get_running_loop())
+        loops.add(asyncio.run(main()))
+
+    def test_loops():
+        # The normal run is the first repetition of the hunt
+        assert len(loops) == 1
+
+    def test_task_leak():
+        async def main():
+            pending.append(asyncio.ensure_future(asyncio.sleep(1000)))
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(main())
+        loop.close()
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-asyncio', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_loop_reused PASSED*',
+        '*::test_loops PASSED*',
+        '*::test_task_leak LEAKED*',
+        '*leaks summary*',
+        '*::test_task_leak: *asyncio tasks: ?1, 1, 1, 1?',
+    ])
+    assert result.ret == 0
+
+
+@pytest.mark.skipif(sys.version_info < (3, 9),
+                    reason='asyncio.to_thread() requires Python >= 3.9')
+def test_asyncio_executor(testdir):
+    test_code = """
+    import asyncio
+
+    def test_to_thread():
+        async def main():
+            return await asyncio.to_thread(sum, [1, 2])
+        assert asyncio.run(main()) == 3
+
+    def test_asyncgen():
+        async def numbers():
+            for i in range(3):
+                yield i
+
+        async def main():
+            return [i async for i in numbers()]
+        assert asyncio.run(main()) == [0, 1, 2]
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-asyncio', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_to_thread PASSED*',
+        '*::test_asyncgen PASSED*',
+    ])
+    assert result.ret == 0
+
+
+def test_leaks_marker(testdir):
+    test_code = """
+    import pytest
+
+    garbage = []
+    runs = {'count': 0}
+    flips = {'count': 0}
+
+    @pytest.mark.leaks(stab=1, run=2)
+    def test_cheap():
+        runs['count'] += 1
+
+    def test_runs():
+        # 3 repetitions, the first one standing for the normal run
+        assert runs['count'] == 3
+
+    @pytest.mark.leaks(thresholds={'references': 200,
+                                   'memory blocks': 200})
+    def test_tolerated():
+        garbage.extend([None] * 100)
+
+    def grow_and_shrink():
+        flips['count'] += 1
+        if flips['count'] % 2 == 0:
+            garbage.extend([None] * 100)
+        else:
+            del garbage[-50:]
+
+    def test_alternating():
+        grow_and_shrink()
+
+    @pytest.mark.leaks(strategy='sum')
+    def test_alternating_sum():
+        grow_and_shrink()
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_cheap PASSED*',
+        '*::test_runs PASSED*',
+        '*::test_tolerated PASSED*',
+        '*::test_alternating PASSED*',
+        '*::test_alternating_sum LEAKED*',
+    ])
+    assert result.ret == 0
+
+
+def test_leaks_marker_no_warmup(testdir):
+    test_code = """
+    import pytest
+
+    garbage = []
+
+    @pytest.mark.leaks(stab=0, run=3)
+    def test_zero():
+        pass
+
+    @pytest.mark.leaks(stab=0, run=3)
+    def test_zero_leak():
+        garbage.extend([None] * 100)
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_zero PASSED*',
+        '*::test_zero_leak LEAKED*',
+        '*leaks summary*',
+        '*::test_zero_leak: leaked references: ?*, 100, 100?*',
+    ])
+    assert result.ret == 0
+
+
+def test_leaks_marker_invalid(testdir):
+    testdir.makepyfile("""
+    import pytest
+
+    @pytest.mark.leaks(strategy='sometimes')
+    def test_sth():
+        pass
+    """)
+
+    result = testdir.runpytest_subprocess('-R', ':')
+
+    result.stderr.fnmatch_lines([
+        "*pytest-leaks: invalid strategy 'sometimes' in leaks marker of "
+        "*::test_sth*",
+    ])
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='--leaks-clear-caches requires Python >= 3.7')
+def test_clear_caches(testdir):
+    testdir.makeini("""
+        [pytest]
+        leaks_cache_allowlist =
+            *:allowed_*
+    """)
+
+    test_code = """
+    import functools
+
+    calls = {'count': 0}
+
+    @functools.lru_cache(maxsize=None)
+    def square(x):
+        return x * x
+
+    @functools.lru_cache(maxsize=None)
+    def allowed_square(x):
+        return x * x
+
+    def test_fills_cache():
+        calls['count'] += 1
+        square(calls['count'] + 1000)
+        allowed_square(calls['count'] + 1000)
+
+    def test_noop():
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-clear-caches', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_fills_cache PASSED*',
+        '*::test_noop PASSED*',
+        '*leaks caches*',
+        '*::test_fills_cache: test_clear_caches:square',
+    ])
+    assert 'test_noop:' not in result.stdout.str()
+    assert result.ret == 0
+
+
+@pytest.mark.skipif(sys.version_info < (3,),
+                    reason='functools.lru_cache requires Python 3')
+def test_cache_index_replaced_module():
+    import functools
+    import types
+
+    from pytest_leaks.caches import CacheIndex
+
+    def make_module(name):
+        module = types.ModuleType(name)
+        module.cached = functools.lru_cache()(lambda x: x)
+        module.cached.__module__ = name
+        return module
+
+    index = CacheIndex()
+    sys.modules['pytest_leaks_test_old'] = make_module(
+        'pytest_leaks_test_old')
+    try:
+        index.update()
+        # One module out, another in: as many modules as before
+        del sys.modules['pytest_leaks_test_old']
+        sys.modules['pytest_leaks_test_new'] = make_module(
+            'pytest_leaks_test_new')
+        index.update()
+    finally:
+        sys.modules.pop('pytest_leaks_test_old', None)
+        sys.modules.pop('pytest_leaks_test_new', None)
+
+    modules = [name.split(':')[0] for name in index.names]
+    assert 'pytest_leaks_test_old' in modules
+    assert 'pytest_leaks_test_new' in modules
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='--leaks-batch requires Python >= 3.7')
+def test_batch(testdir):
+    test_code = """
+    garbage = []
+    runs = {'count': 0}
+
+    def test_leak():
+        garbage.append({})
+
+    def test_runs():
+        runs['count'] += 1
+
+    def test_count():
+        # (5 + 4) repetitions of 10 runs
+        assert runs['count'] == 90
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-batch=10', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_leak LEAKED*',
+        '*::test_runs PASSED*',
+        '*::test_count PASSED*',
+    ])
+    assert result.ret == 0
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11),
+                    reason="requires Python >= 3.11")
+def test_settle(testdir):
+    test_code = """
+    garbage = []
+    runs = {'count': 0}
+
+    def test_leak():
+        garbage.append({})
+
+    def test_runs():
+        # Counting without keeping new references
+        runs['count'] += 1
+
+    def test_count():
+        # Warming up stopped before the 10 repetitions
+        assert runs['count'] < 10 + 3
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', '10:3', '--leaks-settle', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_leak LEAKED*',
+        '*::test_runs PASSED*',
+        '*::test_count PASSED*',
+    ])
+    assert result.ret == 0
+
+
+def test_folded_run(testdir):
+    test_code = """
+    import pytest
+
+    runs = {'count': 0}
+    failing_runs = {'count': 0}
+
+    def test_runs():
+        print("output of the folded run")
+        runs['count'] += 1
+
+    def test_count():
+        # The normal run is the first of the (5 + 4) repetitions
+        assert runs['count'] == 9
+
+    def test_failing():
+        failing_runs['count'] += 1
+        assert False
+
+    def test_failing_count():
+        # The hunt stops after a failed run
+        assert failing_runs['count'] == 1
+
+    @pytest.mark.skip
+    def test_skipped():
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '-v', '-rP'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_runs PASSED*',
+        '*::test_count PASSED*',
+        '*::test_failing FAILED*',
+        '*::test_failing_count PASSED*',
+        '*::test_skipped SKIPPED*',
+        '*output of the folded run*',
+    ])
+    assert result.ret == 1
+
+
+def test_folded_run_other_protocol(testdir):
+    testdir.makeconftest("""
+    def pytest_runtest_protocol(item, nextitem):
+        print("protocol of %s" % (item.name,))
+    """)
+
+    test_code = """
+    garbage = []
+
+    def test_leak():
+        garbage.append({})
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '-v', '-s'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*protocol of test_leak*',
+        '*::test_leak LEAKED*',
+    ])
+    assert result.ret == 0
+
+
+def test_deferred(testdir):
+    test_code = """
+    garbage = []
+    runs = {'count': 0}
+
+    def test_leak():
+        garbage.append({})
+
+    def test_failing():
+        runs['count'] += 1
+        assert False
+
+    def test_count():
+        # Nothing was hunted yet
+        assert runs['count'] == 1
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-deferred', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_leak PASSED*',
+        '*::test_failing FAILED*',
+        '*::test_count PASSED*',
+        '*hunting leaks in 2 tests*',
+        'L.',
+        '*leaks summary*',
+        '*::test_leak: leaked *',
+        '*1 failed, 1 passed, 1 leaked*',
+    ])
+    assert result.ret == 1
+
+
+def test_deferred_junitxml(testdir):
+    testdir.makepyfile("def test_sth(): pass")
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-deferred', '--junitxml=out.xml'
+    )
+
+    result.stderr.fnmatch_lines([
+        "*pytest-leaks: --leaks-deferred can't be used with --junitxml*",
+    ])
+
+
+def test_checkpoint(testdir):
+    test_code = """
+    garbage = []
+
+    def test_leak():
+        with open('runs', 'a') as f:
+            f.write('.')
+        garbage.append({})
+
+    def test_ok():
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+    checkpoint = testdir.tmpdir.join('checkpoint.jsonl')
+
+    # Interrupted after the first test
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-checkpoint=%s' % checkpoint, '-k', 'test_leak'
+    )
+    assert result.ret == 0
+    assert len(checkpoint.readlines()) == 1
+    runs = testdir.tmpdir.join('runs').read()
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-checkpoint=%s' % checkpoint, '--leaks-resume',
+        '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_leak LEAKED*',
+        '*::test_ok PASSED*',
+        '*leaks summary*',
+        '*::test_leak: leaked *',
+        '*leaks checkpoint*',
+        '1 tests restored from *checkpoint.jsonl, 1 tests added',
+    ])
+    assert result.ret == 0
+    assert len(checkpoint.readlines()) == 2
+    assert testdir.tmpdir.join('runs').read() == runs
+
+
+def test_shards(testdir):
+    import json
+
+    test_code = """
+    import pytest
+
+    garbage = []
+
+    def test_leak():
+        garbage.append({})
+
+    @pytest.mark.parametrize('x', range(4))
+    def test_family(x):
+        pass
+
+    def test_a():
+        pass
+
+    def test_b():
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+    checkpoints = [str(testdir.tmpdir.join('shard-%d.jsonl' % i))
+                   for i in (1, 2)]
+    durations = str(testdir.tmpdir.join('durations.json'))
+
+    def run_shards(*args):
+        hunted = []
+        for i, checkpoint in enumerate(checkpoints, 1):
+            result = testdir.runpytest_subprocess(
+                '-R', ':', '--leaks-shard=%d/2' % i,
+                '--leaks-checkpoint=%s' % checkpoint, *args)
+            result.stdout.fnmatch_lines(['*leaks shard*',
+                                         'shard %d/2: * of 7 tests, *' % i])
+            assert result.ret in (0, 5)  # 5: no tests in the shard
+            with open(checkpoint) as f:
+                hunted.append(set(json.loads(line)['nodeid'] for line in f))
+        # Every test is in exactly one shard, with its family
+        assert not hunted[0] & hunted[1]
+        assert len(hunted[0] | hunted[1]) == 7
+        assert any(set('test_shards.py::test_family[%d]' % x
+                       for x in range(4)) <= shard for shard in hunted)
+
+    run_shards()
+
+    result = testdir.run(sys.executable, '-m', 'pytest_leaks.merge',
+                         '--durations', durations, *checkpoints)
+    result.stdout.fnmatch_lines([
+        '7 tests hunted in 2 shards, 1 leaked',
+        '*::test_leak: leaked *',
+    ])
+    assert result.ret == 0
+    with open(durations) as f:
+        assert len(json.load(f)) == 7
+
+    run_shards('--leaks-durations=%s' % durations)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='--leaks-drift requires Python >= 3.7')
+def test_drift(testdir):
+    test_code = """
+    import pytest
+
+    garbage = []
+    runs = {'count': 0}
+
+    def test_leak():
+        garbage.extend([{} for i in range(500)])
+
+    @pytest.mark.parametrize('x', range(10))
+    def test_clean(x):
+        runs['count'] += 1
+
+    def test_count():
+        # Every test runs once
+        assert runs['count'] == 10
+    """
+
+    testdir.makepyfile(test_code)
+
+    # No -R needed
+    result = testdir.runpytest_subprocess('--leaks-drift')
+
+    result.stdout.fnmatch_lines([
+        '*leaks drift*',
+        'session growth over 12 tests: references: +*',
+        'test_drift.py: references: +*',
+        'outliers, worth hunting with -R:',
+        'test_drift.py::test_leak: references: +*',
+        '*12 passed*',
+    ])
+    assert 'test_clean[' not in result.stdout.str()
+    assert result.ret == 0
+
+
+def test_drift_outliers():
+    from pytest_leaks.drift import DriftMonitor
+
+    values = {'fds': 0, 'rss bytes': 0}
+    monitor = DriftMonitor(
+        [(name, lambda name=name: values[name]) for name in sorted(values)],
+        cleanup=lambda: None, minimums={'rss bytes': 64 * 1024})
+    monitor.start()
+    for i in range(10):
+        if i == 3:
+            values['rss bytes'] += 4096  # one page
+        if i == 5:
+            values['fds'] += 1
+        if i == 7:
+            values['rss bytes'] += 1024 * 1024
+        monitor.sample('test_%d' % (i,))
+
+    assert monitor.outliers() == {
+        'test_5': {'fds': 1},
+        'test_7': {'rss bytes': 1024 * 1024},
+    }
+
+
+@pytest.mark.skipif(sys.version_info < (3, 9),
+                    reason='--leaks-peak-memory requires Python >= 3.9')
+def test_peak_memory(testdir):
+    test_code = """
+    def test_big():
+        data = bytearray(16 * 1024 * 1024)
+        del data
+
+    def test_small():
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess('--leaks-peak-memory')
+
+    result.stdout.fnmatch_lines([
+        '*leaks peak memory*',
+        'top 2 of 2 tests by peak traced memory:',
+        'test_peak_memory.py::test_big: * peak bytes, * allocated blocks',
+        'test_peak_memory.py::test_small: * peak bytes, * allocated blocks',
+    ])
+    assert result.ret == 0
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-peak-memory-limit=8M', '-v')
+
+    result.stdout.fnmatch_lines([
+        '*::test_big FAILED*',
+        '*::test_small PASSED*',
+        '*peak traced memory of * bytes exceeds the limit of 8388608 bytes',
+    ])
+    assert result.ret == 1
+
+
+def test_resume_invalid(testdir):
+    testdir.makepyfile("def test_nothing(): pass")
+
+    result = testdir.runpytest_subprocess('-R', ':', '--leaks-resume')
+
+    result.stderr.fnmatch_lines(['*--leaks-resume requires '
+                                 '--leaks-checkpoint'])
+    assert result.ret != 0
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='--leaks-fixtures requires Python >= 3.7')
+def test_fixtures(testdir):
+    testdir.makeconftest("""
+    import pytest
+
+    cache = []
+
+    @pytest.fixture(scope='session')
+    def leaky_session():
+        cache.extend([None] * 100)
+        return cache
+
+    @pytest.fixture(scope='session')
+    def clean_session():
+        return object()
+    """)
+
+    test_code = """
+    import pytest
+
+    registry = []
+
+    @pytest.fixture(scope='module')
+    def depends_on_leaky(leaky_session):
+        return len(leaky_session)
+
+    @pytest.fixture(scope='module', params=[1, 2])
+    def parametrized(request):
+        registry.extend([None] * 100)
+
+    class TestClass(object):
+        @pytest.fixture(scope='class')
+        def class_fixture(self):
+            registry.extend([None] * 100)
+
+        def test_in_class(self, class_fixture):
+            pass
+
+    def test_a(depends_on_leaky, clean_session):
+        pass
+
+    def test_b(parametrized):
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-fixtures', '-v', '-W', 'ignore'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*leaks in fixtures*',
+        '4 higher-scoped fixtures hunted',
+        'class_fixture (class scope, '
+        'test_fixtures:TestClass.class_fixture): leaked references: *',
+        'leaky_session (session scope, conftest:leaky_session): '
+        'leaked references: *',
+    ])
+    assert 'depends_on_leaky (' not in result.stdout.str()
+    assert 'clean_session (' not in result.stdout.str()
+    assert result.ret == 0
+
+
+def test_fixtures_errors(testdir):
+    test_code = """
+    import pytest
+
+    @pytest.fixture(scope='module', params=[1, 2])
+    def parametrized(request):
+        return request.param
+
+    @pytest.fixture(scope='module')
+    def depends_on_parametrized(parametrized):
+        return parametrized
+
+    @pytest.fixture(scope='module')
+    def broken():
+        pytest.fail("broken fixture")
+
+    def test_a(depends_on_parametrized):
+        pass
+
+    def test_b(broken):
+        pass
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-fixtures', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_a?1? PASSED*',
+        '*::test_a?2? PASSED*',
+        '*::test_b ERROR*',
+        '*leaks in fixtures*',
+        '0 higher-scoped fixtures hunted',
+        'broken (module scope, *): error: Failed: broken fixture',
+    ])
+    assert 'INTERNALERROR' not in result.stdout.str()
+    assert 'depends_on_parametrized (' not in result.stdout.str()
+    assert result.ret == 1
+
+
+def test_measure(testdir):
+    test_code = """
+    import sys
+
+    garbage = []
+
+    def leaking():
+        garbage.extend([None] * 100)
+
+    def test_measure(leaks_measure):
+        result = leaks_measure(leaking)
+        assert result
+        assert 'references' in result.leaks
+
+        result = leaks_measure(lambda: None, repeat=3, warmup=2)
+        assert not result
+        assert not result.leaks
+        if sys.version_info >= (3, 7):
+            assert len(result.deltas['references']) == 3
+    """
+
+    testdir.makepyfile(test_code)
+
+    # No -R: leaks_measure works on its own
+    result = testdir.runpytest_subprocess('-v')
+
+    result.stdout.fnmatch_lines([
+        '*::test_measure PASSED*',
+    ])
+    assert result.ret == 0
+
+
+def test_hypothesis_examples(testdir):
+    pytest.importorskip('hypothesis')
+
+    test_code = """
+    import pytest
+    from hypothesis import given, settings, strategies as st
+
+    calls = []
+    full_calls = []
+
+    @settings(max_examples=50)
+    @given(st.integers())
+    def test_property(x):
+        calls.append(x)
+
+    def test_calls():
+        # 50 in the regular run, at most 2 in each of the 8 others
+        assert 50 <= len(calls) <= 50 + 8 * 2
+
+    @pytest.mark.leaks(hypothesis_examples=0)
+    @settings(max_examples=20, database=None)
+    @given(st.integers())
+    def test_full(x):
+        full_calls.append(x)
+
+    def test_full_calls():
+        assert len(full_calls) > 8 * 2
+    """
+
+    testdir.makepyfile(test_code)
+
+    result = testdir.runpytest_subprocess(
+        '-R', ':', '--leaks-hypothesis-examples=2', '-v'
+    )
+
+    result.stdout.fnmatch_lines([
+        '*::test_calls PASSED*',
+        '*::test_full_calls PASSED*',
+    ])
+    assert result.ret == 0